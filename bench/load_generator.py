@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import json
+import time
+
+from core.chat_tool import encode_message, register
+
+BENCH_PREFIX = 'bench'
+
+
+def make_bench_message(client_number, message_number, message_size):
+    header = f'{BENCH_PREFIX} {time.time():.6f} {client_number} {message_number} '
+    return header + 'x' * max(message_size - len(header), 0)
+
+
+def parse_sent_at(chat_line):
+    # chat line looks like "nickname: bench <sent at> <client> <number> xxx"
+    _, _, text = chat_line.partition(': ')
+    parts = text.split(' ', 2)
+    if len(parts) < 2 or parts[0] != BENCH_PREFIX:
+        return None
+    return float(parts[1])
+
+
+async def read_acknowledgements(reader):
+    while await reader.readline():
+        pass
+
+
+async def run_client(host, send_port, client_number, rate, message_size, duration, stats):
+    loop = asyncio.get_event_loop()
+    reader, writer = await asyncio.open_connection(host, send_port)
+    await register(reader, writer, f'bench_{client_number}')
+    # server answers every message, answers are read to keep socket buffers empty
+    acknowledgements = asyncio.ensure_future(read_acknowledgements(reader))
+    started_at = loop.time()
+    message_number = 0
+    try:
+        while loop.time() - started_at < duration:
+            message = make_bench_message(client_number, message_number, message_size)
+            writer.write(encode_message(message) + b'\n')
+            await writer.drain()
+            stats['sent_messages'] += 1
+            stats['sent_bytes'] += len(message)
+            message_number += 1
+            await asyncio.sleep(max(0, started_at + message_number / rate - loop.time()))
+    finally:
+        acknowledgements.cancel()
+        writer.close()
+
+
+async def generate_load(host, send_port, clients_count, rate, message_size, duration):
+    stats = {'sent_messages': 0, 'sent_bytes': 0}
+    started_at = time.monotonic()
+    await asyncio.gather(*[
+        run_client(host, send_port, client_number, rate / clients_count, message_size, duration, stats)
+        for client_number in range(clients_count)
+    ])
+    stats['seconds'] = time.monotonic() - started_at
+    stats['messages_per_second'] = stats['sent_messages'] / stats['seconds']
+    return stats
+
+
+def create_parser_for_user_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', required=False, default='127.0.0.1',
+                        help='chat host',
+                        type=str)
+    parser.add_argument('--send_port', required=False, default=5050,
+                        help='chat port for sending messages',
+                        type=int)
+    parser.add_argument('--clients', required=False, default=10,
+                        help='number of sending clients',
+                        type=int)
+    parser.add_argument('--rate', required=False, default=100,
+                        help='messages per second from all clients',
+                        type=float)
+    parser.add_argument('--message_size', required=False, default=100,
+                        help='message size in characters',
+                        type=int)
+    parser.add_argument('--duration', required=False, default=10,
+                        help='seconds of load',
+                        type=float)
+    namespace = parser.parse_args()
+    return namespace
+
+
+async def main():
+    user_arguments = create_parser_for_user_arguments()
+    stats = await generate_load(
+        user_arguments.host, user_arguments.send_port, user_arguments.clients,
+        user_arguments.rate, user_arguments.message_size, user_arguments.duration
+    )
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        exit()
@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+
+HELLO_MESSAGE = 'Hello %username%! Enter your personal hash or leave it empty to create new account.'
+NICKNAME_PROMPT = 'Enter preferred nickname below:'
+WELCOME_MESSAGE = 'Welcome to chat! Post your message below. End it with an empty line.'
+MESSAGE_SENT = 'Message send. Write more, end message with an empty line.'
+
+
+def encode_line(line):
+    return f'{line}\n'.encode()
+
+
+class MockChatServer:
+    """Stand-in for minechat: chat lines on read port, auth and messages on send port."""
+
+    def __init__(self, host='127.0.0.1', read_port=0, send_port=0, replay_count=10,
+                 accept_any_token=False, max_reader_buffer=16 * 1024 * 1024):
+        self.host = host
+        self.read_port = read_port
+        self.send_port = send_port
+        self.accept_any_token = accept_any_token
+        self.max_reader_buffer = max_reader_buffer
+        self.tokens = {}
+        self.readers = set()
+        self.recent_messages = deque(maxlen=replay_count)
+        self.servers = []
+
+    async def start(self):
+        read_server = await asyncio.start_server(self.handle_reader, self.host, self.read_port)
+        send_server = await asyncio.start_server(self.handle_sender, self.host, self.send_port)
+        self.servers = [read_server, send_server]
+        # real ports, when 0 was asked
+        self.read_port = read_server.sockets[0].getsockname()[1]
+        self.send_port = send_server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        for writer in list(self.readers):
+            writer.close()
+
+    def register(self, nickname):
+        token = uuid.uuid4().hex
+        self.tokens[token] = nickname
+        return token
+
+    def broadcast(self, line):
+        self.recent_messages.append(line)
+        data = encode_line(line)
+        for writer in list(self.readers):
+            if writer.transport.get_write_buffer_size() > self.max_reader_buffer:
+                # too slow reader is disconnected like real server does
+                self.readers.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+
+    async def handle_reader(self, reader, writer):
+        for line in self.recent_messages:
+            writer.write(encode_line(line))
+        self.readers.add(writer)
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            self.readers.discard(writer)
+            writer.close()
+
+    async def handle_sender(self, reader, writer):
+        try:
+            nickname = await self.handshake(reader, writer)
+            if not nickname:
+                return
+            message_lines = []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().rstrip('\r\n')
+                if line:
+                    message_lines.append(line)
+                    continue
+                if message_lines:
+                    self.broadcast(f'{nickname}: {" ".join(message_lines)}')
+                    message_lines = []
+                writer.write(encode_line(MESSAGE_SENT))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handshake(self, reader, writer):
+        writer.write(encode_line(HELLO_MESSAGE))
+        token = (await reader.readline()).decode().strip()
+        if token:
+            nickname = self.tokens.get(token)
+            if not nickname and self.accept_any_token:
+                nickname = self.tokens[token] = f'user_{token[:8]}'
+            if not nickname:
+                writer.write(encode_line('null'))
+                await writer.drain()
+                return None
+        else:
+            writer.write(encode_line(NICKNAME_PROMPT))
+            nickname = (await reader.readline()).decode().strip() or f'user_{uuid.uuid4().hex[:8]}'
+            token = self.register(nickname)
+        writer.write(encode_line(json.dumps({'nickname': nickname, 'account_hash': token})))
+        writer.write(encode_line(WELCOME_MESSAGE))
+        await writer.drain()
+        return nickname
+
+
+def create_parser_for_user_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', required=False, default='127.0.0.1',
+                        help='host to listen',
+                        type=str)
+    parser.add_argument('--read_port', required=False, default=5000,
+                        help='port for reading messages',
+                        type=int)
+    parser.add_argument('--send_port', required=False, default=5050,
+                        help='port for sending messages',
+                        type=int)
+    parser.add_argument('--accept_any_token', required=False,
+                        help='authorise any token as new user',
+                        action='store_true')
+    namespace = parser.parse_args()
+    return namespace
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    user_arguments = create_parser_for_user_arguments()
+    server = MockChatServer(
+        user_arguments.host, user_arguments.read_port, user_arguments.send_port,
+        accept_any_token=user_arguments.accept_any_token
+    )
+    await server.start()
+    logging.info(f'mock chat is listening on {server.host}:{server.read_port} and {server.host}:{server.send_port}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        exit()
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from bench.load_generator import generate_load, parse_sent_at
+from bench.mock_server import MockChatServer
+from core.chat_reader import read_stream_chat
+from core.chat_tool import read_message_from_chat
+from core.history import HistoryLog, HistoryPager
+from core.logs import DEFAULT_LOG_SAMPLE_RATE, setup_logging, stop_logging
+from core.message import ChatMessage
+from core.metrics import metrics
+from core.processing import PROCESSING_POOLS, MessageProcessor, load_rules
+from core.watchdog import ConnectionLiveness
+
+
+def get_percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50': values[len(values) // 2],
+        'p95': values[int(len(values) * 0.95)],
+        'p99': values[int(len(values) * 0.99)],
+        'max': values[-1],
+    }
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def count_messages(queue, expected_count, all_received):
+    received_count = 0
+    while received_count < expected_count:
+        await queue.get()
+        received_count += 1
+    all_received.set()
+
+
+async def drain_queue(queue):
+    while True:
+        await queue.get()
+
+
+async def benchmark_end_to_end(clients_count, rate, message_size, duration):
+    server = MockChatServer()
+    await server.start()
+    reader, writer = await asyncio.open_connection(server.host, server.read_port)
+    latencies = []
+
+    async def read_chat():
+        while True:
+            sent_at = parse_sent_at(await read_message_from_chat(reader))
+            if sent_at:
+                latencies.append(time.time() - sent_at)
+
+    reading = asyncio.ensure_future(read_chat())
+    try:
+        load_stats = await generate_load(server.host, server.send_port, clients_count, rate, message_size, duration)
+        # last messages are still on the way
+        await asyncio.sleep(0.5)
+    finally:
+        reading.cancel()
+        writer.close()
+        await server.close()
+    return {
+        'load': load_stats,
+        'received_messages': len(latencies),
+        'latency_seconds': get_percentiles(latencies),
+    }
+
+
+async def benchmark_reader(messages_count, message_size, message_processor=None):
+    """Mock server and client share one event loop, so throughput includes server work."""
+    server = MockChatServer(replay_count=0)
+    await server.start()
+    reader, writer = await asyncio.open_connection(server.host, server.read_port)
+    while not server.readers:
+        await asyncio.sleep(0.01)
+    messages_queue = asyncio.Queue()
+    history_queue = asyncio.Queue()
+    all_received = asyncio.Event()
+    tasks = [
+        asyncio.ensure_future(read_stream_chat(
+            reader, messages_queue, history_queue, ConnectionLiveness(('read',)), message_processor=message_processor
+        )),
+        asyncio.ensure_future(count_messages(messages_queue, messages_count, all_received)),
+        asyncio.ensure_future(drain_queue(history_queue)),
+    ]
+    line = f'flood: {"x" * message_size}'
+    started_at = time.monotonic()
+    try:
+        for message_number in range(messages_count):
+            server.broadcast(line)
+            if not message_number % 1000:
+                await asyncio.sleep(0)
+        await all_received.wait()
+        seconds = time.monotonic() - started_at
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+        await server.close()
+    return {
+        'messages': messages_count,
+        'seconds': seconds,
+        'messages_per_second': messages_count / seconds,
+        'bytes_per_second': messages_count * len(line) / seconds,
+    }
+
+
+async def benchmark_logging(messages_count, message_size):
+    """Reader throughput with log records written to /dev/null through queue listener."""
+    results = {}
+    settings = (
+        ('info', 'INFO', DEFAULT_LOG_SAMPLE_RATE),
+        ('debug_sampled', 'DEBUG', DEFAULT_LOG_SAMPLE_RATE),
+        ('debug_every_message', 'DEBUG', messages_count),
+    )
+    with open(os.devnull, 'w') as null_stream:
+        for name, level, sample_rate in settings:
+            listener = setup_logging(level, sample_rate, null_stream)
+            try:
+                results[name] = (await benchmark_reader(messages_count, message_size))['messages_per_second']
+            finally:
+                stop_logging(listener)
+    for name in ('debug_sampled', 'debug_every_message'):
+        results[f'{name}_overhead_percent'] = round(100 * (results['info'] / results[name] - 1), 1)
+    return results
+
+
+async def measure_loop_lag(lags, interval=0.005):
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started_at - interval)
+
+
+async def benchmark_processing(messages_count, message_size):
+    """Reader throughput and event loop lag with message rules in thread and process pools."""
+    rules, display_rules = load_rules('links,highlight,mask', 'flood', 'xxx')
+    results = {}
+    for name in ('no_rules',) + PROCESSING_POOLS:
+        lags = []
+        lag_measuring = asyncio.ensure_future(measure_loop_lag(lags))
+        try:
+            if name == 'no_rules':
+                reader_results = await benchmark_reader(messages_count, message_size)
+            else:
+                with MessageProcessor(rules, display_rules, name) as message_processor:
+                    reader_results = await benchmark_reader(messages_count, message_size, message_processor)
+        finally:
+            lag_measuring.cancel()
+        results[name] = {
+            'messages_per_second': reader_results['messages_per_second'],
+            'loop_lag_seconds': get_percentiles(lags),
+        }
+    return results
+
+
+async def benchmark_history_write(messages_count, message_size, batch_size):
+    now = time.time()
+    messages = [
+        ChatMessage(now, 'history', f'{"x" * message_size} {message_number}')
+        for message_number in range(messages_count)
+    ]
+    with tempfile.TemporaryDirectory() as history_log_path:
+        started_at = time.monotonic()
+        async with HistoryLog(history_log_path) as history_log:
+            for position in range(0, messages_count, batch_size):
+                await history_log.write(messages[position:position + batch_size])
+        seconds = time.monotonic() - started_at
+    written_bytes = sum(len(message.to_record()) + 1 for message in messages)
+    return {
+        'messages': messages_count,
+        'batch_size': batch_size,
+        'seconds': seconds,
+        'messages_per_second': messages_count / seconds,
+        'bytes_per_second': written_bytes / seconds,
+    }
+
+
+async def benchmark_gui_render(messages_count, message_size, batch_size):
+    if not os.getenv('DISPLAY'):
+        return {'skipped': 'no display'}
+    import tkinter as tk
+
+    from core import gui
+
+    root = tk.Tk()
+    panel = tk.Text(root, wrap='none')
+    panel.pack()
+    messages_queue = asyncio.Queue()
+    for message_number in range(messages_count):
+        messages_queue.put_nowait(
+            ChatMessage(time.time(), 'render', f'{"x" * message_size} {message_number}', message_number)
+        )
+    frame_times = []
+    with tempfile.TemporaryDirectory() as history_log_path:
+        view = gui.ConversationView(panel, tk.Scrollbar(root), gui.MessageStore(HistoryPager(history_log_path)))
+        rendering = asyncio.gather(
+            gui.update_conversation_history(view, messages_queue, batch_size, 0),
+            view.scheduler.run()
+        )
+        started_at = time.monotonic()
+        try:
+            while not messages_queue.empty():
+                await asyncio.sleep(0)
+                frame_started_at = time.perf_counter()
+                root.update()
+                frame_times.append(time.perf_counter() - frame_started_at)
+            seconds = time.monotonic() - started_at
+        finally:
+            rendering.cancel()
+            root.destroy()
+    render_summary = metrics.histograms['gui_render_seconds']
+    return {
+        'messages': messages_count,
+        'seconds': seconds,
+        'messages_per_second': messages_count / seconds,
+        'frame_seconds': get_percentiles(frame_times),
+        'render_seconds_mean': render_summary.mean,
+        'render_seconds_max': render_summary.max,
+    }
+
+
+def compare_results(previous, current, path=''):
+    for name, value in current.items():
+        previous_value = previous.get(name) if isinstance(previous, dict) else None
+        if isinstance(value, dict):
+            compare_results(previous_value or {}, value, f'{path}{name}.')
+        elif isinstance(value, (int, float)) and isinstance(previous_value, (int, float)) and previous_value:
+            change = (value - previous_value) / previous_value * 100
+            print(f'{path}{name}: {previous_value:.6g} -> {value:.6g} ({change:+.1f}%)')
+
+
+def create_parser_for_user_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', required=False, default=10,
+                        help='number of sending clients in end to end benchmark',
+                        type=int)
+    parser.add_argument('--rate', required=False, default=500,
+                        help='messages per second from all clients',
+                        type=float)
+    parser.add_argument('--message_size', required=False, default=100,
+                        help='message size in characters',
+                        type=int)
+    parser.add_argument('--duration', required=False, default=5,
+                        help='seconds of end to end load',
+                        type=float)
+    parser.add_argument('--messages', required=False, default=100000,
+                        help='messages in reader, history and render benchmarks',
+                        type=int)
+    parser.add_argument('--batch', required=False, default=1000,
+                        help='batch size in history and render benchmarks',
+                        type=int)
+    parser.add_argument('--output', required=False,
+                        help='file to save results in json',
+                        type=str)
+    parser.add_argument('--compare', required=False,
+                        help='json file with previous results to compare with',
+                        type=str)
+    namespace = parser.parse_args()
+    return namespace
+
+
+async def main():
+    user_arguments = create_parser_for_user_arguments()
+    results = {
+        'timestamp': time.time(),
+        'revision': get_revision(),
+        'python': platform.python_version(),
+        'parameters': vars(user_arguments),
+        'end_to_end': await benchmark_end_to_end(
+            user_arguments.clients, user_arguments.rate, user_arguments.message_size, user_arguments.duration
+        ),
+        'reader': await benchmark_reader(user_arguments.messages, user_arguments.message_size),
+        'logging': await benchmark_logging(user_arguments.messages, user_arguments.message_size),
+        'processing': await benchmark_processing(user_arguments.messages, user_arguments.message_size),
+        'history_write': await benchmark_history_write(
+            user_arguments.messages, user_arguments.message_size, user_arguments.batch
+        ),
+        'gui_render': await benchmark_gui_render(
+            user_arguments.messages, user_arguments.message_size, user_arguments.batch
+        ),
+    }
+    print(json.dumps(results, indent=2))
+    if user_arguments.output:
+        with open(user_arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if user_arguments.compare:
+        with open(user_arguments.compare) as previous_file:
+            previous_results = json.load(previous_file)
+        for benchmark_name in ('end_to_end', 'reader', 'logging', 'processing', 'history_write', 'gui_render'):
+            compare_results(previous_results.get(benchmark_name, {}), results[benchmark_name], f'{benchmark_name}.')
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        exit()
@@ -7,17 +7,22 @@ import socket
 import sys
 from contextlib import asynccontextmanager
 from json import JSONDecodeError
-from tkinter import Tk, Entry, Button, END, messagebox, Frame, Label
+from tkinter import Tk, Entry, Button, END, messagebox, Frame, Label, TclError
 
 from aiofile import AIOFile
 
-from core.chat_tool import get_open_connection_tools, SendingConnectionStateChanged, register
+from core.chat_tool import Backoff, get_open_connection, SendingConnectionStateChanged, register
+from core.chat_writer import ChatCredentials
 from core.gui import update_tk, TkAppClosed
-from gui_chat import create_handy_nursery
+from core.logs import DEFAULT_LOG_LEVEL, LOG_LEVELS, setup_logging
+from core.session import create_handy_nursery
 
 
 class Registered(Exception):
-    pass
+    def __init__(self, credentials, connection=None):
+        super().__init__(credentials.nickname)
+        self.credentials = credentials
+        self.connection = connection
 
 
 def get_nickname(nickname_input, register_queue):
@@ -43,7 +48,8 @@ async def register_process(reader, writer, register_queue, status_updates_queue)
             'Неудачная регистрация',
             'Неудачная регистрация. Попробуйте еще раз'
         )
-        raise
+        # register_new_user opens new connection and waits for next nickname
+        yield
     except (
             socket.gaierror,
             ConnectionRefusedError,
@@ -55,25 +61,34 @@ async def register_process(reader, writer, register_queue, status_updates_queue)
         status_updates_queue.put_nowait(SendingConnectionStateChanged.CLOSED)
 
 
-async def register_new_user(host, port, attempts, status_updates_queue, register_queue, token_file_path):
+async def register_new_user(host, port, attempts, status_updates_queue, register_queue, token_file_path,
+                            keep_connection=False):
+    # kept between attempts, so delay keeps growing while server is down
+    backoff = Backoff()
     while True:
-        async with contextlib.AsyncExitStack() as stack:
-            reader, writer = await stack.enter_async_context(
-                get_open_connection_tools(host, port, attempts, status_updates_queue, SendingConnectionStateChanged)
-            )
-            result = await stack.enter_async_context(
-                register_process(reader, writer, register_queue, status_updates_queue)
-            )
-            if not result:
-                continue
-            token = result.get('account_hash')
-            registered_nickname = result.get('nickname')
-            await save_token(token, token_file_path)
-            messagebox.showinfo(
-                "Успешная регистрация", f"Ваш ник: {registered_nickname}\n"
-                f"Ваш токен сохранен в файле: {token_file_path}"
-            )
-            raise Registered
+        try:
+            reader, writer = await get_open_connection(host, port, attempts, backoff=backoff)
+        except ConnectionError:
+            status_updates_queue.put_nowait(SendingConnectionStateChanged.CLOSED)
+            continue
+        result = None
+        try:
+            async with register_process(reader, writer, register_queue, status_updates_queue) as result:
+                pass
+        finally:
+            # connection of registered user is logged in, chat session may go on with it
+            if not (keep_connection and result):
+                writer.close()
+        if not result:
+            continue
+        credentials = ChatCredentials()
+        credentials.set_validated(result.get('account_hash'), result.get('nickname'))
+        await save_token(credentials.token, token_file_path)
+        messagebox.showinfo(
+            "Успешная регистрация", f"Ваш ник: {credentials.nickname}\n"
+            f"Ваш токен сохранен в файле: {token_file_path}"
+        )
+        raise Registered(credentials, (reader, writer) if keep_connection else None)
 
 
 async def update_status(status_updates_queue, write_label):
@@ -100,9 +115,31 @@ async def draw_register_window(register_queue, status_updates_queue):
     register_button.pack()
     status_read_label.pack()
 
-    async with create_handy_nursery() as nursery:
-        nursery.start_soon(update_tk(root_frame))
-        nursery.start_soon(update_status(status_updates_queue, status_read_label))
+    try:
+        async with create_handy_nursery() as nursery:
+            nursery.start_soon(update_tk(root_frame))
+            nursery.start_soon(update_status(status_updates_queue, status_read_label))
+    finally:
+        # chat window may be opened next in the same process
+        with contextlib.suppress(TclError):
+            root.destroy()
+
+
+async def register_user(host, port, attempts, token_file_path, keep_connection=False):
+    """Show register window until user is registered, return credentials and kept connection."""
+    register_queue = asyncio.Queue()
+    status_updates_queue = asyncio.Queue()
+    try:
+        async with create_handy_nursery() as nursery:
+            nursery.start_soon(
+                draw_register_window(register_queue, status_updates_queue)
+            )
+            nursery.start_soon(
+                register_new_user(host, port, attempts, status_updates_queue, register_queue, token_file_path,
+                                  keep_connection)
+            )
+    except Registered as registered:
+        return registered.credentials, registered.connection
 
 
 def create_parser_for_user_arguments():
@@ -119,14 +156,20 @@ def create_parser_for_user_arguments():
     parser.add_argument('--token_file_path', required=False,
                         help='file with token dir path',
                         type=str)
+    parser.add_argument('--log_level', required=False,
+                        help='lowest level of written log records',
+                        choices=LOG_LEVELS)
     namespace = parser.parse_args()
     return namespace
 
 
 async def main():
-    main_logger = logging.getLogger('')
-    main_logger.setLevel(logging.DEBUG)
     user_arguments = create_parser_for_user_arguments()
+    log_level = user_arguments.log_level or os.getenv('LOG_LEVEL', DEFAULT_LOG_LEVEL).upper()
+    if log_level not in LOG_LEVELS:
+        logging.error(f'unknown log level {log_level}')
+        sys.exit(2)
+    setup_logging(log_level)
     host = user_arguments.host or os.getenv('HOST', 'minechat.dvmn.org')
     port = user_arguments.port or os.getenv('SEND_PORT', 5050)
     attempts = int(user_arguments.attempts or os.getenv('ATTEMPTS_COUNT', 3))
@@ -139,16 +182,7 @@ async def main():
         sys.exit(2)
     elif not token_file_path:
         token_file_path = './token.txt'
-    register_queue = asyncio.Queue()
-    status_updates_queue = asyncio.Queue()
-
-    async with create_handy_nursery() as nursery:
-        nursery.start_soon(
-            draw_register_window(register_queue, status_updates_queue)
-        )
-        nursery.start_soon(
-            register_new_user(host, port, attempts, status_updates_queue, register_queue, token_file_path)
-        )
+    await register_user(host, port, attempts, token_file_path)
 
 
 if __name__ == '__main__':
@@ -157,7 +191,6 @@ if __name__ == '__main__':
     except (
             Registered,
             KeyboardInterrupt,
-            TkAppClosed,
-            JSONDecodeError
+            TkAppClosed
     ):
         exit()
@@ -1,18 +1,173 @@
-from aiofile import AIOFile
+import asyncio
+import itertools
+import time
+from collections import deque
 
-from core.chat_tool import read_message_from_chat
+from core.chat_tool import LineFramer, get_queue_batch, read_messages_from_chat
+from core.logs import SampledLogger
+from core.message import ChatMessage
+from core.metrics import metrics
 
+DEFAULT_REPLAY_WINDOW = 1000
+DEFAULT_REPLAY_HOLD_TIME = 1
 
-async def save_messages(history_log_path, queue):
-    async with AIOFile(f'{history_log_path}/history_logs.txt', 'a+') as log_file:
+received_lines_logger = SampledLogger('chat_reader')
+
+
+def get_fingerprint(line):
+    # only hash of the line is kept, so window memory does not depend on line length
+    return hash(line)
+
+
+class ReplayFilter:
+    """Drops messages which server sends again after read connection is reopened.
+
+    Fingerprints of last received lines are kept in a ring of fixed size with positions of every fingerprint,
+    so memory is fixed by window and a line out of replay costs O(1).
+    Server replay is the tail of the window: while incoming lines match part of the window in order they are held,
+    when the match reaches the last remembered line they are dropped and replay is over,
+    on mismatch or when no line comes for hold_time held messages are let through.
+    Lines given on start are compared as they are, lines changed or dropped by stored rules do not match replay.
+    """
+
+    def __init__(self, recent_lines=(), window=DEFAULT_REPLAY_WINDOW, hold_time=DEFAULT_REPLAY_HOLD_TIME):
+        self.window = window
+        self.hold_time = hold_time
+        # fingerprint of line number n is kept at n % window
+        self.fingerprints = [None] * window
+        self.end = 0
+        # fingerprint: numbers of its lines in the window
+        self.positions = {}
+        self.resuming = False
+        self.candidates = None
+        self.held_messages = []
+        self.remember_lines(recent_lines)
+
+    def remember_lines(self, lines):
+        for line in lines:
+            self.remember(get_fingerprint(line))
+
+    def remember(self, fingerprint):
+        if self.end >= self.window:
+            oldest = self.fingerprints[self.end % self.window]
+            oldest_positions = self.positions[oldest]
+            oldest_positions.popleft()
+            if not oldest_positions:
+                del self.positions[oldest]
+        self.fingerprints[self.end % self.window] = fingerprint
+        self.positions.setdefault(fingerprint, deque()).append(self.end)
+        self.end += 1
+
+    def resume(self):
+        self.resuming = bool(self.end)
+        self.candidates = None
+        self.held_messages = []
+
+    def feed(self, message):
+        fingerprint = get_fingerprint(message.to_line())
+        if not self.resuming:
+            self.remember(fingerprint)
+            return [message]
+        matched = len(self.held_messages)
+        if self.candidates is None:
+            # window is not changed during replay, so positions stay valid
+            candidates = list(self.positions.get(fingerprint, ()))
+        else:
+            candidates = [
+                position for position in self.candidates
+                if position + matched < self.end
+                and self.fingerprints[(position + matched) % self.window] == fingerprint
+            ]
+        if not candidates:
+            self.held_messages.append(message)
+            return self.release_held()
+        if any(position + matched + 1 == self.end for position in candidates):
+            # replay ends with the last remembered line, later repeats are live messages
+            metrics.inc('replayed_messages_dropped', matched + 1)
+            self.resuming = False
+            self.held_messages = []
+            return []
+        self.candidates = candidates
+        self.held_messages.append(message)
+        return []
+
+    def release_held(self):
+        """End replay and let held messages through, when the burst stops before the last remembered line."""
+        self.resuming = False
+        messages, self.held_messages = self.held_messages, []
+        for message in messages:
+            self.remember(get_fingerprint(message.to_line()))
+        return messages
+
+
+async def save_messages(history_log, queue):
+    getting = None
+    try:
         while True:
-            message = await queue.get()
-            await log_file.write(f'{message}\n')
+            getting = getting or asyncio.ensure_future(
+                get_queue_batch(queue, history_log.write_batch, history_log.write_latency)
+            )
+            # in quiet chat the last batch is synced by time, not only by next write
+            done, _ = await asyncio.wait({getting}, timeout=history_log.get_fsync_delay())
+            if not done:
+                await history_log.sync()
+                continue
+            messages, getting = getting.result(), None
+            await history_log.write(messages)
+    finally:
+        if getting:
+            getting.cancel()
+
 
+async def put_messages(messages, messages_queue, history_queue, spool, sequence_numbers, message_processor):
+    if spool:
+        # replayed old line with the same text must not confirm new message, so echo is checked after filter
+        for message in messages:
+            spool.confirm_echo(message.to_line())
+    if message_processor and messages:
+        # history keeps messages after stored rules only, window and sink get them after display rules
+        processed_messages = await message_processor.process(messages)
+    else:
+        processed_messages = [(message, message) for message in messages]
+    metrics.inc('received_messages', len(processed_messages))
+    if received_lines_logger.is_enabled():
+        for message, _ in processed_messages:
+            received_lines_logger.debug('received: %s', message.to_line())
+    for message, shown_message in processed_messages:
+        # dropped messages leave no gaps in numbers
+        message.sequence_number = shown_message.sequence_number = next(sequence_numbers)
+        if messages_queue is not None:
+            await messages_queue.put(shown_message)
+        if history_queue is not None:
+            await history_queue.put(message)
 
-async def read_stream_chat(reader, messages_queue, history_queue, watchdog_queue):
-    while True:
-        decoded_data = await read_message_from_chat(reader)
-        messages_queue.put_nowait(decoded_data)
-        history_queue.put_nowait(decoded_data)
-        watchdog_queue.put_nowait('Read connection is alive. New message in chat')
+
+async def read_stream_chat(reader, messages_queue, history_queue, liveness, replay_filter=None, spool=None,
+                           framer=None, sequence_numbers=None, message_processor=None):
+    framer = framer or LineFramer()
+    # sequence numbers go on from history log, so they are the same in window, history and search
+    sequence_numbers = sequence_numbers or itertools.count()
+    reading = None
+    try:
+        while True:
+            if replay_filter and replay_filter.held_messages or reading:
+                # held line may be live message, in quiet chat it is let through by time
+                reading = reading or asyncio.ensure_future(read_messages_from_chat(reader, framer))
+                timeout = replay_filter.hold_time if replay_filter.held_messages else None
+                done, _ = await asyncio.wait({reading}, timeout=timeout)
+                if not done:
+                    await put_messages(replay_filter.release_held(), messages_queue, history_queue, spool,
+                                       sequence_numbers, message_processor)
+                    continue
+                received_lines, reading = reading.result(), None
+            else:
+                received_lines = await read_messages_from_chat(reader, framer)
+            received_at = time.time()
+            liveness.touch('read')
+            messages = [ChatMessage.from_line(line, received_at) for line in received_lines]
+            if replay_filter:
+                messages = [released for message in messages for released in replay_filter.feed(message)]
+            await put_messages(messages, messages_queue, history_queue, spool, sequence_numbers, message_processor)
+    finally:
+        if reading:
+            reading.cancel()
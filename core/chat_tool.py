@@ -1,11 +1,22 @@
 import asyncio
 import json
 import logging
+import random
 import socket
+import time
 from contextlib import asynccontextmanager
 from enum import Enum
 
-from async_timeout import timeout
+from core.metrics import metrics
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 30
+# connection which is up that long is not counted as failed attempt
+DEFAULT_STABLE_CONNECTION_SECONDS = 10
+DEFAULT_MAX_LINE_LENGTH = 64 * 1024
+OVERSIZE_POLICIES = ('truncate', 'skip')
+READ_CHUNK_SIZE = 256 * 1024
 
 
 class ReadConnectionStateChanged(Enum):
@@ -31,10 +42,58 @@ class NicknameReceived:
         self.nickname = nickname
 
 
+class Backoff:
+    """Capped exponential delay with full jitter, so clients do not reconnect in lockstep."""
+
+    def __init__(self, base=DEFAULT_BACKOFF_BASE, max_delay=DEFAULT_BACKOFF_MAX):
+        self.base = base
+        self.max_delay = max_delay
+        self.failures = 0
+
+    def get_delay(self):
+        delay = min(self.max_delay, self.base * 2 ** self.failures)
+        self.failures += 1
+        return random.uniform(0, delay)
+
+    def reset(self):
+        self.failures = 0
+
+
+class ConnectionRateLimiter:
+    """Token bucket shared by sessions, so mass reconnect is spread in time."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # waiting sessions are let in one by one in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
 @asynccontextmanager
-async def get_open_connection_tools(host, port, attempts):
+async def get_open_connection_tools(host, port, attempts, connect_timeout=DEFAULT_CONNECT_TIMEOUT, backoff=None):
+    reader, writer = await get_open_connection(host, port, attempts, connect_timeout, backoff)
+    try:
+        yield reader, writer
+    finally:
+        writer.close()
+
+
+@asynccontextmanager
+async def use_open_connection(reader, writer):
     try:
-        reader, writer = await get_open_connection(host, port, attempts)
         yield reader, writer
     finally:
         writer.close()
@@ -56,55 +115,138 @@ async def read_message_from_chat(reader):
     return decoded_data
 
 
-async def write_message_to_chat(writer, message=None):
+class LineFramer:
+    """Splits chat stream into lines, many lines of one chunk are decoded at once.
+
+    Line longer than max_line_length is truncated or skipped instead of breaking connection,
+    its tail is not kept in memory.
+    """
+
+    def __init__(self, max_line_length=DEFAULT_MAX_LINE_LENGTH, oversize_policy='truncate'):
+        self.max_line_length = max_line_length
+        self.oversize_policy = oversize_policy
+        self.buffer = bytearray()
+        # head of oversize line, None while line is not oversize
+        self.oversize_head = None
+
+    def feed(self, data):
+        if self.oversize_head is not None:
+            line_end = data.find(b'\n')
+            if line_end == -1:
+                return []
+            lines = list(self._cut_oversize(self.oversize_head))
+            self.oversize_head = None
+            data = data[line_end + 1:]
+        else:
+            lines = []
+        buffer = self.buffer
+        buffer += data
+        last_line_end = buffer.rfind(b'\n')
+        if last_line_end == -1:
+            if len(buffer) > self.max_line_length:
+                self.oversize_head = bytes(buffer[:self.max_line_length])
+                del buffer[:]
+            return lines
+        text = buffer[:last_line_end].decode('utf-8', errors='replace')
+        del buffer[:last_line_end + 1]
+        new_lines = text.split('\n')
+        if '\r' in text:
+            new_lines = [line.rstrip('\r') for line in new_lines]
+        if last_line_end > self.max_line_length:
+            new_lines = [
+                cut_line
+                for line in new_lines
+                for cut_line in (self._cut_oversize(line) if len(line) > self.max_line_length else (line,))
+            ]
+        lines.extend(new_lines)
+        if len(buffer) > self.max_line_length:
+            self.oversize_head = bytes(buffer[:self.max_line_length])
+            del buffer[:]
+        return lines
+
+    def _cut_oversize(self, line):
+        metrics.inc('oversize_lines')
+        if self.oversize_policy == 'skip':
+            return ()
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='ignore')
+        return (line[:self.max_line_length].rstrip('\r'),)
+
+
+async def read_messages_from_chat(reader, framer):
+    """Return lines of next received chunk, may be empty while line is not finished."""
+    data = await reader.read(READ_CHUNK_SIZE)
+    if not data:
+        raise ConnectionResetError('connection is closed by server')
+    metrics.inc('received_bytes', len(data))
+    return framer.feed(data)
+
+
+def encode_message(message=None):
     if not message:
-        message = '\n'
-    else:
-        message = message.replace('\n', '').strip()
-        message = f'{message}\n'
-    message = f'{message}'
-    writer.write(message.encode())
+        return b'\n'
+    message = message.replace('\n', '').strip()
+    return f'{message}\n'.encode()
+
+
+async def write_message_to_chat(writer, message=None):
+    writer.write(encode_message(message))
     await writer.drain()
 
 
-async def get_open_connection(host, port, attempts):
-    attempts_count = 0
-    reader = None
-    writer = None
-    while not reader:
+async def get_queue_batch(queue, max_batch, max_latency=0):
+    message = await queue.get()
+    batch = [message]
+    if max_latency:
+        # give the burst a chance to accumulate before the batch is handed out
+        await asyncio.sleep(max_latency)
+    while len(batch) < max_batch:
         try:
-            reader, writer = await asyncio.open_connection(host, port)
+            batch.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    return batch
+
+
+async def get_open_connection(host, port, attempts, connect_timeout=DEFAULT_CONNECT_TIMEOUT, backoff=None):
+    """Try to connect `attempts` times with growing delay, then raise ConnectionError.
+
+    backoff is kept by caller between calls, so delay keeps growing while server is down,
+    caller resets it when connection has stayed up for a while.
+    """
+    backoff = backoff or Backoff()
+    for _ in range(max(int(attempts), 1)):
+        started_at = time.monotonic()
+        metrics.inc('connect_attempts')
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), connect_timeout)
         except (
                 socket.gaierror,
                 ConnectionRefusedError,
                 ConnectionResetError,
                 ConnectionError,
-        ):
-
-            if attempts_count < int(attempts):
-                error_msg = 'Нет соединения. Повторная попытка.'
-                logging.debug(error_msg)
-                attempts_count += 1
-                continue
-            else:
-                error_msg = 'Нет соединения. Повторная попытка через 3 сек.'
-                logging.debug(error_msg)
-                await asyncio.sleep(3)
-                continue
-        else:
-            success_connect_msg = 'Соединение установлено'
-            logging.debug(success_connect_msg)
-    return reader, writer
+                OSError,
+                asyncio.TimeoutError,
+        ) as error:
+            metrics.inc('connect_failures')
+            delay = backoff.get_delay()
+            logging.debug(f'Нет соединения с {host}:{port} ({error!r}). Повторная попытка через {delay:.1f} сек.')
+            await asyncio.sleep(delay)
+            continue
+        metrics.observe('connect_seconds', time.monotonic() - started_at)
+        success_connect_msg = 'Соединение установлено'
+        logging.debug(success_connect_msg)
+        return reader, writer
+    raise ConnectionError(f'{host}:{port} is not available after {attempts} attempts')
 
 
-async def send_watchdog_messages(writer, reader, watchdog_queue):
+async def send_watchdog_messages(writer, reader, liveness):
     while True:
         try:
             writer.write(f'\n'.encode())
             await writer.drain()
-            async with timeout(5):
-                await reader.readline()
-            watchdog_queue.put_nowait('Send connection is alive')
+            await asyncio.wait_for(reader.readline(), 5)
+            liveness.touch('send')
             await asyncio.sleep(3)
             # because context manager doesn't work
         except asyncio.TimeoutError:
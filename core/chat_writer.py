@@ -1,25 +1,65 @@
 import json
-import logging
+import time
 
+from core.chat_tool import encode_message, read_message_from_chat, register, write_message_to_chat
+from core.logs import SampledLogger
+from core.metrics import metrics
 
-from core.chat_tool import read_message_from_chat, write_message_to_chat
+DEFAULT_SEND_BATCH = 100
+
+sent_messages_logger = SampledLogger('chat_writer')
 
 
 class InvalidToken(Exception):
     pass
 
 
-async def send_msgs(queue, writer, watchdog_queue):
-    message = await queue.get()
-    await write_message_to_chat(writer, f'{message}\n\n')
-    logging.debug(message)
-    watchdog_queue.put_nowait('Message sent')
+class ChatCredentials:
+    """Token and nickname of chat user, shared by all send connections of one session.
+
+    After the token is accepted once, later connections send it without waiting for greeting,
+    and a user registered on the first connection is authorised on reconnect instead of registered again.
+    """
+
+    def __init__(self, token=None, nickname=None):
+        self.token = token
+        self.nickname = nickname
+        self.validated = False
+
+    def set_validated(self, token, nickname):
+        self.token = token
+        self.nickname = nickname
+        self.validated = True
+
 
+async def send_msgs(spool, writer, liveness, max_batch=DEFAULT_SEND_BATCH):
+    entries = await spool.get_batch(max_batch)
+    # entries are in flight before write, so failed write is sent again after reconnect
+    spool.mark_sent(entries)
+    # every message ends with empty line, whole batch goes with one write and one drain
+    data = b''.join(encode_message(message) + b'\n' for _, message, _ in entries)
+    writer.write(data)
+    await writer.drain()
+    drained_at = time.monotonic()
+    for _, message, enqueued_at in entries:
+        sent_messages_logger.debug('sent: %s', message)
+        # waiting in spool is counted too, not only write of the batch
+        metrics.observe('send_latency_seconds', drained_at - enqueued_at)
+    metrics.inc('sent_messages', len(entries))
+    metrics.inc('sent_bytes', len(data))
+    metrics.observe('send_batch_size', len(entries))
+    liveness.touch('send')
 
-async def authorise(reader, writer, token, watchdog_queue):
-    await read_message_from_chat(reader)
-    await write_message_to_chat(writer, f'{token}\n')
-    watchdog_queue.put_nowait('Prompt before auth')
+
+async def authorise(reader, writer, token, liveness, pipelined=False):
+    if pipelined:
+        # server reads token after greeting anyway, so one round trip is saved
+        await write_message_to_chat(writer, f'{token}\n')
+        await read_message_from_chat(reader)
+    else:
+        await read_message_from_chat(reader)
+        await write_message_to_chat(writer, f'{token}\n')
+    liveness.touch('send')
     decoded_data = await read_message_from_chat(reader)
     json_data = json.loads(decoded_data)
     if not json_data:
@@ -28,10 +68,18 @@ async def authorise(reader, writer, token, watchdog_queue):
     return nickname
 
 
-async def write_stream_chat(writer, sending_queue, watchdog_queue):
-    while True:
-        await send_msgs(sending_queue, writer, watchdog_queue)
-
-
+async def log_in(reader, writer, credentials, liveness):
+    if credentials.token:
+        nickname = await authorise(reader, writer, credentials.token, liveness, pipelined=credentials.validated)
+        credentials.set_validated(credentials.token, nickname)
+        return
+    user_data = await register(reader, writer)
+    liveness.touch('send')
+    credentials.set_validated(user_data.get('account_hash'), user_data.get('nickname'))
 
 
+async def write_stream_chat(writer, spool, liveness, max_batch=DEFAULT_SEND_BATCH):
+    # messages not confirmed by previous connection go first, in the same order
+    spool.requeue_in_flight()
+    while True:
+        await send_msgs(spool, writer, liveness, max_batch)
@@ -1,9 +1,28 @@
+import _tkinter
 import asyncio
+import logging
+import threading
+import itertools
+import time
 import tkinter as tk
-from tkinter.scrolledtext import ScrolledText
-
-from core.chat_tool import ReadConnectionStateChanged, SendingConnectionStateChanged, NicknameReceived
-from gui_chat import create_handy_nursery
+import tkinter.font
+import tkinter.ttk
+from collections import deque
+
+from core.chat_tool import (
+    ReadConnectionStateChanged,
+    SendingConnectionStateChanged,
+    NicknameReceived,
+    get_queue_batch
+)
+from core.message import ChatMessage
+from core.metrics import metrics
+from core.processing import apply_display_rules
+from core.session import create_handy_nursery
+
+GUI_MODES = ('poll', 'adaptive', 'thread')
+DEFAULT_VIEW_MARGIN = 100
+WHEEL_SCROLL_LINES = 3
 
 
 class TkAppClosed(Exception):
@@ -12,33 +31,410 @@ class TkAppClosed(Exception):
 
 def process_new_message(input_field, sending_queue):
     text = input_field.get()
-    sending_queue.put_nowait(text)
+    try:
+        sending_queue.put_nowait(text)
+    except asyncio.QueueFull:
+        # text stays in input field, user can send it again later
+        return
     input_field.delete(0, tk.END)
 
 
 async def update_tk(root_frame, interval=1 / 120):
     while True:
+        started_at = time.perf_counter()
         try:
             root_frame.update()
         except tk.TclError:
             # if application has been destroyed/closed
             raise TkAppClosed()
+        metrics.observe('gui_frame_seconds', time.perf_counter() - started_at)
         await asyncio.sleep(interval)
 
 
-async def update_conversation_history(panel, messages_queue):
+async def update_tk_adaptive(root_frame, interval=1 / 120, max_interval=1 / 20):
+    current_interval = interval
     while True:
-        msg = await messages_queue.get()
+        started_at = time.perf_counter()
+        handled_events_count = 0
+        try:
+            # only pending window events and redraws, nothing is done when app is idle
+            while root_frame.tk.dooneevent(_tkinter.ALL_EVENTS | _tkinter.DONT_WAIT):
+                handled_events_count += 1
+        except tk.TclError:
+            # if application has been destroyed/closed
+            raise TkAppClosed()
+        if handled_events_count:
+            metrics.observe('gui_frame_seconds', time.perf_counter() - started_at)
+            current_interval = interval
+        else:
+            current_interval = min(current_interval * 2, max_interval)
+        await asyncio.sleep(current_interval)
+
+
+def is_tk_thread_supported():
+    return tk.Tcl().eval('set tcl_platform(threaded)') == '1'
+
+
+class TkThread:
+    """Tk mainloop in its own thread, window events are handled while event loop is busy.
+
+    Tk call made from loop thread after mainloop returned waits for it and fails with RuntimeError,
+    so loop tasks touching widgets are guarded and such errors end them with TkAppClosed.
+    """
+
+    def __init__(self):
+        # set in tk thread, so it is seen even while loop thread is blocked by tk call
+        self.stopped = threading.Event()
+        self.closed = asyncio.Event()
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        root_created = loop.create_future()
+
+        def run_tk():
+            root = tk.Tk()
+            loop.call_soon_threadsafe(root_created.set_result, root)
+            try:
+                root.mainloop()
+            finally:
+                self.stopped.set()
+                loop.call_soon_threadsafe(self.closed.set)
+
+        threading.Thread(target=run_tk, daemon=True).start()
+        return await root_created
+
+    async def wait_closed(self):
+        await self.closed.wait()
+        raise TkAppClosed()
+
+    async def guard(self, coroutine):
+        try:
+            await coroutine
+        except (tk.TclError, RuntimeError):
+            if not self.stopped.is_set():
+                raise
+            raise TkAppClosed()
+
+    def create_bridge(self, loop):
+        def bridge(callback):
+            # tk callbacks run in tk thread, asyncio objects are touched only in loop thread;
+            # tk calls made from loop thread are passed to tk thread by threaded tcl
+            def call_in_loop(*args):
+                if not self.stopped.is_set():
+                    callback(*args)
+
+            return lambda *args: loop.call_soon_threadsafe(call_in_loop, *args)
+
+        return bridge
+
+
+def format_body(message):
+    chunks = []
+    position = 0
+    for start, end, tag in sorted(message.spans):
+        # overlapping marks are not nested, the first one is shown
+        if start < position:
+            continue
+        chunks.extend((message.body[position:start], '', message.body[start:end], tag))
+        position = end
+    chunks.extend((message.body[position:], ''))
+    return chunks
+
+
+def format_messages(messages):
+    """Text and tags for one panel.insert call, one line per message."""
+    chunks = []
+    for message in messages:
+        if chunks:
+            chunks.extend(('\n', ''))
+        message_time = message.format_time()
+        if message_time:
+            chunks.extend((f'{message_time} ', 'message_time'))
+        if message.author:
+            chunks.extend((f'{message.author}: ', 'message_author'))
+        if message.spans:
+            chunks.extend(format_body(message))
+        else:
+            chunks.extend((message.body, ''))
+    return chunks
+
+
+class MessageStore:
+    """Messages by sequence number, recent ones are kept in memory, older ones are read from history log."""
+
+    def __init__(self, history_pager, max_messages=0):
+        self.history_pager = history_pager
+        self.recent = deque(maxlen=max_messages or None)
+        self.end = 0
+
+    @property
+    def memory_start(self):
+        return self.recent[0].sequence_number if self.recent else self.end
+
+    def extend(self, messages):
+        first_number = messages[-1].sequence_number - len(messages) + 1
+        if messages[0].sequence_number != first_number or self.recent and first_number != self.end:
+            # messages were dropped by queue, memory keeps only lines without gaps, the rest is in history log
+            self.recent.clear()
+            first_index = len(messages) - 1
+            while first_index and (
+                    messages[first_index - 1].sequence_number == messages[first_index].sequence_number - 1):
+                first_index -= 1
+            messages = messages[first_index:]
+        self.recent.extend(messages)
+        self.end = self.recent[-1].sequence_number + 1
+
+    async def read(self, start, count):
+        stop = min(start + count, self.end)
+        messages = []
+        if start < self.memory_start:
+            messages = await self.history_pager.read_range(start, min(stop, self.memory_start) - start)
+        # memory may move on while history is read
+        memory_start = self.memory_start
+        if stop > memory_start:
+            first_index = max(start + len(messages) - memory_start, 0)
+            messages.extend(itertools.islice(self.recent, first_index, stop - memory_start))
+        return messages
+
+
+class ConversationView:
+    """Chat window over message store, widget holds only visible lines and margin around them.
+
+    Lines are materialized when view is scrolled out of them, so widget size does not grow with chat.
+    New messages move the view only while it sticks to the bottom, user reading older lines is not disturbed.
+    """
+
+    def __init__(self, panel, scrollbar, store, margin=DEFAULT_VIEW_MARGIN, scheduler=None):
+        self.panel = panel
+        self.scrollbar = scrollbar
+        self.store = store
+        self.margin = margin
+        self.line_height = tkinter.font.Font(root=panel, font=panel['font']).metrics('linespace')
+        self.visible_lines = 1
+        self.top = 0
+        self.sticky = True
+        self.found_sequence_number = None
+        # sequence number of the first line in widget and lines count in it
+        self.window_start = 0
+        self.window_size = 0
+        self.scheduler = scheduler or RenderScheduler()
+        # view of not selected tab is not rendered until the tab is shown
+        self.hidden = False
+
+    @property
+    def last_top(self):
+        return max(self.store.end - self.visible_lines, 0)
+
+    def is_materialized(self):
+        window_end = self.window_start + self.window_size
+        return self.window_start <= self.top and min(self.top + self.visible_lines, self.store.end) <= window_end
+
+    def show(self):
+        if not self.is_materialized():
+            self.scheduler.request(self)
+            return
+        if self.window_size:
+            self.panel.yview_moveto((self.top - self.window_start) / self.window_size)
+        self.update_scrollbar()
+
+    def update_scrollbar(self):
+        end = self.store.end
+        if not end:
+            self.scrollbar.set(0, 1)
+            return
+        self.scrollbar.set(self.top / end, min(self.top + self.visible_lines, end) / end)
+
+    def scroll_to(self, top):
+        self.top = min(max(top, 0), self.last_top)
+        self.sticky = self.top == self.last_top
+        self.show()
+
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(round(float(amount) * self.store.end))
+        elif unit == 'pages':
+            self.scroll_to(self.top + int(amount) * self.visible_lines)
+        else:
+            self.scroll_to(self.top + int(amount))
+
+    def on_mouse_wheel(self, event):
+        # X11 sends buttons 4 and 5, other platforms send delta
+        if event.num == 4 or event.num != 5 and event.delta > 0:
+            self.scroll_to(self.top - WHEEL_SCROLL_LINES)
+        else:
+            self.scroll_to(self.top + WHEEL_SCROLL_LINES)
+
+    def on_resize(self, event):
+        self.visible_lines = max(event.height // self.line_height, 1)
+        if self.sticky:
+            self.top = self.last_top
+        self.show()
+
+    def add_messages(self, messages):
+        window_end = self.window_start + self.window_size
+        self.store.extend(messages)
+        if self.hidden:
+            # widget of hidden tab is rendered once when it is shown
+            if self.sticky:
+                self.top = self.last_top
+            self.window_size = 0
+            return
+        # batch without gaps right after the last widget line is just appended
+        first_number = messages[0].sequence_number
+        is_window_continued = self.window_size and window_end == first_number == self.store.end - len(messages)
+        if not self.sticky:
+            # widget is not changed while user reads older messages, only scrollbar shows that chat goes on
+            self.update_scrollbar()
+            return
+        self.top = self.last_top
+        if not is_window_continued:
+            self.show()
+            return
+        self.panel['state'] = 'normal'
+        self.panel.insert('end', '\n', '', *format_messages(messages))
+        self.window_size += len(messages)
+        extra_lines_count = self.window_size - self.visible_lines - 2 * self.margin
+        if extra_lines_count > 0:
+            self.panel.delete('1.0', f'{extra_lines_count + 1}.0')
+            self.window_start += extra_lines_count
+            self.window_size -= extra_lines_count
+        self.panel['state'] = 'disabled'
+        self.show()
+
+    def jump_to(self, sequence_number):
+        self.found_sequence_number = sequence_number
+        self.sticky = False
+        self.top = max(sequence_number - self.visible_lines // 2, 0)
+        # found line is marked by full render
+        self.window_size = 0
+        self.scheduler.request(self)
+
+    def jump_to_latest(self):
+        self.found_sequence_number = None
+        self.sticky = True
+        self.window_size = 0
+        self.scheduler.request(self)
+
+    async def render(self):
+        self.top = self.last_top if self.sticky else min(self.top, self.last_top)
+        start = max(self.top - self.margin, 0)
+        messages = await self.store.read(start, self.visible_lines + 2 * self.margin)
+        self.panel['state'] = 'normal'
+        self.panel.delete('1.0', tk.END)
+        if messages:
+            self.panel.insert('1.0', *format_messages(messages))
+        found_line = (self.found_sequence_number or 0) - start + 1
+        if self.found_sequence_number is not None and 0 < found_line <= len(messages):
+            self.panel.tag_add('found', f'{found_line}.0', f'{found_line}.end')
+        self.panel['state'] = 'disabled'
+        self.window_start, self.window_size = start, len(messages)
+        # view may be moved while lines were read, then one more render is requested
+        self.show()
+
+
+def open_link(panel, event):
+    import webbrowser
+
+    index = panel.index(f'@{event.x},{event.y}')
+    link_range = panel.tag_prevrange('message_link', f'{index}+1c')
+    if link_range:
+        webbrowser.open(panel.get(*link_range))
+
+
+def bind_view_scroll(panel, view, bridge):
+    on_mouse_wheel = bridge(view.on_mouse_wheel)
+
+    def on_wheel_event(event):
+        on_mouse_wheel(event)
+        # widget does not scroll by itself, it holds only part of the chat
+        return 'break'
+
+    for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+        panel.bind(sequence, on_wheel_event)
+    panel.bind('<Configure>', bridge(view.on_resize))
+    view.scrollbar['command'] = bridge(view.on_scrollbar)
+
+
+class RenderScheduler:
+    """One render task for chat views of all tabs, views of hidden tabs wait until they are shown."""
+
+    def __init__(self):
+        self.requested_views = []
+        self.render_requested = asyncio.Event()
+
+    def request(self, view):
+        if view not in self.requested_views:
+            self.requested_views.append(view)
+        self.render_requested.set()
+
+    def show(self, shown_view, views):
+        for view in views:
+            view.hidden = view is not shown_view
+        shown_view.show()
+
+    async def run(self):
+        while True:
+            await self.render_requested.wait()
+            self.render_requested.clear()
+            views = [view for view in self.requested_views if not view.hidden]
+            self.requested_views = [view for view in self.requested_views if view.hidden]
+            for view in views:
+                started_at = time.perf_counter()
+                await view.render()
+                metrics.observe('gui_view_render_seconds', time.perf_counter() - started_at)
+
+
+async def update_conversation_history(view, messages_queue, max_batch=1000, max_latency=1 / 30,
+                                      startup_trace=None):
+    while True:
+        # one insert and one scroll per frame instead of one per message
+        messages = await get_queue_batch(messages_queue, max_batch, max_latency)
+        started_at = time.perf_counter()
+        view.add_messages(messages)
+        metrics.observe('gui_render_seconds', time.perf_counter() - started_at)
+        # history is shown first, first message of this run comes from server
+        if startup_trace and startup_trace.is_received_after_start(messages[-1]):
+            startup_trace.mark('first_message')
+
 
-        panel['state'] = 'normal'
-        if panel.index('end-1c') != '1.0':
-            panel.insert('end', '\n')
-        panel.insert('end', msg)
-        # TODO сделать промотку умной, чтобы не мешала просматривать историю сообщений
-        # ScrolledText.frame
-        # ScrolledText.vbar
-        panel.yview(tk.END)
-        panel['state'] = 'disabled'
+def process_search_query(search_field, search_requests):
+    search_requests.put_nowait(search_field.get())
+
+
+def process_found_message_choice(results_list, found_messages, jump_requests):
+    selection = results_list.curselection()
+    if selection:
+        jump_requests.put_nowait(found_messages[selection[0]])
+
+
+async def search_history(search_index, search_requests, results_list, found_messages, conversation_frame,
+                         display_rules=()):
+    while True:
+        query = await search_requests.get()
+        results = await search_index.search(query)
+        found_messages[:] = [sequence_number for sequence_number, _ in results]
+        results_list.delete(0, tk.END)
+        if not results:
+            results_list.pack_forget()
+            continue
+        # index keeps original text, masked words are not shown in results either
+        found_texts = [
+            message.body
+            for message in apply_display_rules(display_rules, [ChatMessage(None, '', text) for _, text in results])
+        ]
+        results_list.insert(tk.END, *found_texts)
+        results_list.pack(side="top", fill=tk.X, before=conversation_frame)
+
+
+async def jump_to_message(view, jump_requests, latest_button):
+    while True:
+        view.jump_to(await jump_requests.get())
+        latest_button.pack(side="left")
+
+
+def show_latest_messages(view, latest_button):
+    view.jump_to_latest()
+    latest_button.pack_forget()
 
 
 async def update_status_panel(status_labels, status_updates_queue):
@@ -60,6 +456,26 @@ async def update_status_panel(status_labels, status_updates_queue):
             nickname_label['text'] = f'Имя пользователя: {msg.nickname}'
 
 
+def create_search_panel(root_frame):
+    search_frame = tk.Frame(root_frame)
+    search_frame.pack(side="top", fill=tk.X)
+
+    search_field = tk.Entry(search_frame)
+    search_field.pack(side="left", fill=tk.X, expand=True)
+
+    search_button = tk.Button(search_frame)
+    search_button["text"] = "Найти"
+    search_button.pack(side="left")
+
+    # shown only while chat window is scrolled to found message
+    latest_button = tk.Button(search_frame)
+    latest_button["text"] = "К новым сообщениям"
+
+    results_list = tk.Listbox(root_frame, height=6)
+
+    return (search_field, search_button, latest_button, results_list)
+
+
 def create_status_panel(root_frame):
     status_frame = tk.Frame(root_frame)
     status_frame.pack(side="bottom", fill=tk.X)
@@ -79,32 +495,127 @@ def create_status_panel(root_frame):
     return (nickname_label, status_read_label, status_write_label)
 
 
-async def draw(messages_queue, sending_queue, status_updates_queue):
-    root = tk.Tk()
+class RoomPage:
+    """Status, search, input field and chat view of one room, in its own tab when there are several rooms."""
+
+    def __init__(self, page_frame, room, bridge, scheduler, scrollback_lines=10000, view_margin=DEFAULT_VIEW_MARGIN):
+        self.room = room
+        self.bridge = bridge
+        self.status_labels = create_status_panel(page_frame)
+        if room.search_index:
+            self.search_field, self.search_button, self.latest_button, self.results_list = \
+                create_search_panel(page_frame)
+
+        input_frame = tk.Frame(page_frame)
+        input_frame.pack(side="bottom", fill=tk.X)
+
+        input_field = tk.Entry(input_frame)
+        input_field.pack(side="left", fill=tk.X, expand=True)
+
+        input_field.bind("<Return>", bridge(lambda event: process_new_message(input_field, room.sending_spool)))
+
+        send_button = tk.Button(input_frame)
+        send_button["text"] = "Отправить"
+        send_button["command"] = bridge(lambda: process_new_message(input_field, room.sending_spool))
+        send_button.pack(side="left")
+
+        self.conversation_frame = tk.Frame(page_frame)
+        self.conversation_frame.pack(side="top", fill="both", expand=True)
+        # scrollbar shows position in the whole chat, not in lines of widget
+        conversation_scrollbar = tk.Scrollbar(self.conversation_frame)
+        conversation_scrollbar.pack(side="right", fill=tk.Y)
+        conversation_panel = tk.Text(self.conversation_frame, wrap='none', state='disabled')
+        conversation_panel.pack(side="left", fill="both", expand=True)
+        conversation_panel.tag_configure('found', background='yellow')
+        conversation_panel.tag_configure('message_time', foreground='grey')
+        conversation_panel.tag_configure('message_author', foreground='blue')
+        conversation_panel.tag_configure('message_highlight', background='#ffe4b5')
+        conversation_panel.tag_configure('message_link', foreground='blue', underline=True)
+        # browser is opened right from tk callback, loop is not needed for it
+        conversation_panel.tag_bind('message_link', '<Button-1>', lambda event: open_link(conversation_panel, event))
+        self.conversation_view = ConversationView(
+            conversation_panel, conversation_scrollbar, MessageStore(room.history_pager, scrollback_lines),
+            view_margin, scheduler
+        )
+        bind_view_scroll(conversation_panel, self.conversation_view, bridge)
+
+    async def run(self, render_max_batch=1000, render_max_latency=1 / 30, startup_trace=None):
+        room, bridge, conversation_view = self.room, self.bridge, self.conversation_view
+        async with create_handy_nursery() as nursery:
+            nursery.start_soon(update_conversation_history(
+                conversation_view, room.messages_queue, render_max_batch, render_max_latency, startup_trace
+            ))
+            if room.search_index:
+                search_field, latest_button, results_list = self.search_field, self.latest_button, self.results_list
+                search_requests = asyncio.Queue()
+                jump_requests = asyncio.Queue()
+                found_messages = []
+                search_field.bind(
+                    "<Return>", bridge(lambda event: process_search_query(search_field, search_requests))
+                )
+                self.search_button["command"] = bridge(lambda: process_search_query(search_field, search_requests))
+                latest_button["command"] = bridge(lambda: show_latest_messages(conversation_view, latest_button))
+                results_list.bind(
+                    "<<ListboxSelect>>",
+                    bridge(lambda event: process_found_message_choice(results_list, found_messages, jump_requests))
+                )
+                nursery.start_soon(search_history(
+                    room.search_index, search_requests, results_list, found_messages, self.conversation_frame,
+                    room.history_pager.display_rules
+                ))
+                nursery.start_soon(jump_to_message(conversation_view, jump_requests, latest_button))
+            nursery.start_soon(update_status_panel(self.status_labels, room.status_updates_queue))
+
+
+async def draw(rooms, render_max_batch=1000, render_max_latency=1 / 30, scrollback_lines=10000,
+               view_margin=DEFAULT_VIEW_MARGIN, gui_mode='adaptive', gui_max_interval=1 / 20, startup_trace=None):
+    if gui_mode == 'thread' and not is_tk_thread_supported():
+        logging.warning('tcl is built without threads, adaptive gui mode is used')
+        gui_mode = 'adaptive'
+    tk_thread = None
+    if gui_mode == 'thread':
+        tk_thread = TkThread()
+        root = await tk_thread.start()
+        bridge = tk_thread.create_bridge(asyncio.get_event_loop())
+    else:
+        root = tk.Tk()
+
+        def bridge(callback):
+            return callback
 
     root.title('Чат Майнкрафтера')
+    if startup_trace:
+        root.bind('<Map>', bridge(lambda event: startup_trace.mark('window')), add='+')
 
     root_frame = tk.Frame()
     root_frame.pack(fill="both", expand=True)
 
-    status_labels = create_status_panel(root_frame)
-
-    input_frame = tk.Frame(root_frame)
-    input_frame.pack(side="bottom", fill=tk.X)
-
-    input_field = tk.Entry(input_frame)
-    input_field.pack(side="left", fill=tk.X, expand=True)
-
-    input_field.bind("<Return>", lambda event: process_new_message(input_field, sending_queue))
-
-    send_button = tk.Button(input_frame)
-    send_button["text"] = "Отправить"
-    send_button["command"] = lambda: process_new_message(input_field, sending_queue)
-    send_button.pack(side="left")
-
-    conversation_panel = ScrolledText(root_frame, wrap='none')
-    conversation_panel.pack(side="top", fill="both", expand=True)
+    scheduler = RenderScheduler()
+    if len(rooms) == 1:
+        pages = [RoomPage(root_frame, rooms[0], bridge, scheduler, scrollback_lines, view_margin)]
+    else:
+        notebook = tkinter.ttk.Notebook(root_frame)
+        notebook.pack(fill="both", expand=True)
+        pages = []
+        for room in rooms:
+            page_frame = tk.Frame(notebook)
+            notebook.add(page_frame, text=room.name)
+            pages.append(RoomPage(page_frame, room, bridge, scheduler, scrollback_lines, view_margin))
+        views = [page.conversation_view for page in pages]
+        for view in views[1:]:
+            view.hidden = True
+        notebook.bind(
+            '<<NotebookTabChanged>>',
+            bridge(lambda event: scheduler.show(views[notebook.index('current')], views))
+        )
+    tasks = [scheduler.run()] + [page.run(render_max_batch, render_max_latency, startup_trace) for page in pages]
     async with create_handy_nursery() as nursery:
-        nursery.start_soon(update_tk(root_frame))
-        nursery.start_soon(update_conversation_history(conversation_panel, messages_queue))
-        nursery.start_soon(update_status_panel(status_labels, status_updates_queue))
+        if tk_thread:
+            nursery.start_soon(tk_thread.wait_closed())
+            tasks = [tk_thread.guard(task) for task in tasks]
+        elif gui_mode == 'adaptive':
+            nursery.start_soon(update_tk_adaptive(root_frame, max_interval=gui_max_interval))
+        else:
+            nursery.start_soon(update_tk(root_frame))
+        for task in tasks:
+            nursery.start_soon(task)
@@ -0,0 +1,120 @@
+import asyncio
+import importlib
+import logging
+import os
+import sys
+
+from aiofile import AIOFile
+
+from core.chat_tool import NicknameReceived, ReadConnectionStateChanged, get_queue_batch
+from core.chat_writer import DEFAULT_SEND_BATCH, InvalidToken
+from core.metrics import metrics
+from core.session import create_handy_nursery, handle_connection
+from core.spool import SPOOL_FILE_NAME, OutboundSpool
+
+DEFAULT_SESSION_QUEUE_SIZE = 1000
+DEFAULT_SINK_BATCH = 100
+
+
+class SessionsFileError(Exception):
+    pass
+
+
+class HeadlessSession:
+    """One authorised chat user without window.
+
+    sink is called as `await sink(session, messages)` with batch of received ChatMessage,
+    bot can answer with `session.sending_queue.put_nowait(text)`.
+    """
+
+    def __init__(self, name, token, sink=None, history_log=None, queue_size=DEFAULT_SESSION_QUEUE_SIZE):
+        self.name = name
+        self.token = token
+        self.sink = sink
+        self.history_log = history_log
+        self.nickname = None
+        # nobody reads the queue when there is no sink or history, so lines are not kept at all
+        self.messages_queue = asyncio.Queue(queue_size) if sink else None
+        self.history_queue = asyncio.Queue(queue_size) if history_log else None
+        # bot answers are kept on disk next to session history, else only in memory
+        spool_path = os.path.join(history_log.history_log_path, SPOOL_FILE_NAME) if history_log else None
+        self.sending_queue = OutboundSpool(spool_path, queue_size)
+        self.status_updates_queue = asyncio.Queue()
+
+
+async def print_sink(session, messages):
+    sys.stdout.write(''.join(f'{session.name}: {message.to_line()}\n' for message in messages))
+
+
+SINKS = {
+    'print': print_sink,
+    'null': None,
+}
+
+
+def load_sink(sink_name):
+    """Return built-in sink or `package.module:function` coroutine."""
+    if sink_name in SINKS:
+        return SINKS[sink_name]
+    module_name, _, function_name = sink_name.partition(':')
+    if not function_name:
+        raise ValueError(f'unknown sink {sink_name}')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+async def read_sessions_file(sessions_file_path):
+    """Read `token` or `name token` lines, `#` starts a comment."""
+    async with AIOFile(sessions_file_path) as sessions_file:
+        content = await sessions_file.read()
+    sessions = []
+    for line_number, line in enumerate(content.splitlines(), 1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) > 2:
+            raise SessionsFileError(f'{sessions_file_path}:{line_number} expected "token" or "name token"')
+        token = fields[-1]
+        name = fields[0] if len(fields) == 2 else f'session_{len(sessions) + 1}'
+        sessions.append((name, token))
+    names = [name for name, _ in sessions]
+    if len(set(names)) != len(names):
+        raise SessionsFileError(f'{sessions_file_path} has repeated session names')
+    return sessions
+
+
+async def watch_session_status(session):
+    while True:
+        status = await session.status_updates_queue.get()
+        if isinstance(status, NicknameReceived):
+            session.nickname = status.nickname
+            logging.info(f'{session.name}: authorised as {status.nickname}')
+        elif status is ReadConnectionStateChanged.CLOSED:
+            metrics.inc('headless_disconnects')
+            logging.info(f'{session.name}: connection is closed, reconnecting')
+
+
+async def feed_sink(session, max_batch):
+    while True:
+        messages = await get_queue_batch(session.messages_queue, max_batch)
+        await session.sink(session, messages)
+        metrics.inc('headless_sink_messages', len(messages))
+
+
+async def run_session(session, host, read_port, send_port, attempts, rate_limiter=None,
+                      watchdog_timeout=5, send_max_batch=DEFAULT_SEND_BATCH, sink_max_batch=DEFAULT_SINK_BATCH,
+                      **connection_settings):
+    try:
+        async with session.sending_queue, create_handy_nursery() as nursery:
+            nursery.start_soon(watch_session_status(session))
+            if session.sink:
+                nursery.start_soon(feed_sink(session, sink_max_batch))
+            nursery.start_soon(
+                handle_connection(host, read_port, send_port, session.messages_queue, session.history_queue,
+                                  session.sending_queue, session.status_updates_queue, session.token, attempts,
+                                  session.history_log, watchdog_timeout, send_max_batch=send_max_batch,
+                                  rate_limiter=rate_limiter, **connection_settings)
+            )
+    except InvalidToken:
+        # one bad token does not stop other sessions
+        metrics.inc('headless_invalid_tokens')
+        logging.error(f'{session.name}: token is not accepted, session is stopped')
@@ -0,0 +1,526 @@
+import asyncio
+import gzip
+import importlib.util
+import io
+import mmap
+import os
+import re
+import shutil
+import struct
+import time
+from datetime import date
+
+from aiofile import AIOFile
+
+from core.message import ChatMessage
+from core.metrics import metrics
+from core.processing import apply_display_rules
+
+LEGACY_HISTORY_FILE_NAME = 'history_logs.txt'
+SEGMENT_FILE_RE = re.compile(r'^history_logs\.(\d+)\.txt(\.gz|\.zst)?$')
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+# timestamp, message sequence number, offset in segment
+INDEX_RECORD = struct.Struct('<dQQ')
+
+READ_BLOCK_SIZE = 64 * 1024
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_INDEX_STRIDE = 32
+DEFAULT_WRITE_BATCH = 1000
+DEFAULT_WRITE_LATENCY = 0.05
+DEFAULT_FSYNC_BYTES = 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 1
+
+
+def get_segment_path(history_log_path, number, suffix=''):
+    return os.path.join(history_log_path, f'history_logs.{number:06d}.txt{suffix}')
+
+
+def get_index_path(history_log_path, number):
+    return os.path.join(history_log_path, f'history_logs.{number:06d}.idx')
+
+
+def list_segments(history_log_path):
+    numbers = set()
+    for file_name in os.listdir(history_log_path):
+        match = SEGMENT_FILE_RE.match(file_name)
+        if match:
+            numbers.add(int(match.group(1)))
+    return sorted(numbers)
+
+
+def find_segment_path(history_log_path, number):
+    # plain file wins, compressed copy may be not finished yet
+    for suffix in ('', '.gz', '.zst'):
+        segment_path = get_segment_path(history_log_path, number, suffix)
+        if os.path.exists(segment_path):
+            return segment_path
+
+
+def is_zstandard_installed():
+    # zstandard is optional and imported only when zstd segment is read or written
+    return importlib.util.find_spec('zstandard') is not None
+
+
+def open_segment(segment_path):
+    if segment_path.endswith('.gz'):
+        with gzip.open(segment_path, 'rb') as segment_file:
+            return io.BytesIO(segment_file.read())
+    if segment_path.endswith('.zst'):
+        import zstandard
+        with open(segment_path, 'rb') as segment_file:
+            return io.BytesIO(zstandard.ZstdDecompressor().stream_reader(segment_file).read())
+    return open(segment_path, 'rb')
+
+
+def compress_segment(segment_path, compression):
+    compressed_path = f'{segment_path}{COMPRESSION_SUFFIXES[compression]}'
+    with open(segment_path, 'rb') as source, open(f'{compressed_path}.tmp', 'wb') as target:
+        if compression == 'zstd':
+            import zstandard
+            zstandard.ZstdCompressor().copy_stream(source, target)
+        else:
+            with gzip.GzipFile(fileobj=target, mode='wb') as gzip_file:
+                shutil.copyfileobj(source, gzip_file)
+    os.replace(f'{compressed_path}.tmp', compressed_path)
+    os.remove(segment_path)
+
+
+def read_index(index_path):
+    if not os.path.exists(index_path):
+        return b''
+    with open(index_path, 'rb') as index_file:
+        index = index_file.read()
+    # drop record torn by crash
+    return index[:len(index) - len(index) % INDEX_RECORD.size]
+
+
+def read_first_index_record(history_log_path, number):
+    index_path = get_index_path(history_log_path, number)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'rb') as index_file:
+        record = index_file.read(INDEX_RECORD.size)
+    if len(record) < INDEX_RECORD.size:
+        return None
+    return INDEX_RECORD.unpack(record)
+
+
+def search_index(index, key, field):
+    # last record with record[field] <= key
+    low, high = 0, len(index) // INDEX_RECORD.size
+    while low < high:
+        middle = (low + high) // 2
+        if INDEX_RECORD.unpack_from(index, middle * INDEX_RECORD.size)[field] <= key:
+            low = middle + 1
+        else:
+            high = middle
+    if not low:
+        return None
+    return INDEX_RECORD.unpack_from(index, (low - 1) * INDEX_RECORD.size)
+
+
+def find_history_position(history_log_path, timestamp=None, sequence_number=None):
+    """Return (segment number, offset, lines to skip) of message received at timestamp or with sequence number."""
+    field, key = (1, sequence_number) if sequence_number is not None else (0, timestamp)
+    numbers = list_segments(history_log_path)
+    low, high = 0, len(numbers)
+    while low < high:
+        middle = (low + high) // 2
+        record = read_first_index_record(history_log_path, numbers[middle])
+        if record and record[field] <= key:
+            low = middle + 1
+        else:
+            high = middle
+    if not low:
+        return (numbers[0], 0, 0) if numbers else None
+
+    number = numbers[low - 1]
+    with open(get_index_path(history_log_path, number), 'rb') as index_file, \
+            mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index:
+        # only touched pages of index are read
+        _, record_sequence_number, offset = search_index(
+            memoryview(index)[:len(index) - len(index) % INDEX_RECORD.size], key, field
+        )
+    if sequence_number is not None:
+        return number, offset, sequence_number - record_sequence_number
+    return number, offset, 0
+
+
+def count_lines(segment_file, start_offset, block_size=READ_BLOCK_SIZE):
+    segment_file.seek(start_offset)
+    lines_count = 0
+    for block in iter(lambda: segment_file.read(block_size), b''):
+        lines_count += block.count(b'\n')
+    return lines_count
+
+
+def read_lines_before(segment_file, end_offset, count, block_size=READ_BLOCK_SIZE):
+    if end_offset is None:
+        end_offset = segment_file.seek(0, os.SEEK_END)
+    position = end_offset
+    data = b''
+    # read file backwards until enough lines are collected, whole file is never loaded
+    while position > 0 and data.count(b'\n') <= count:
+        step = min(block_size, position)
+        position -= step
+        segment_file.seek(position)
+        data = segment_file.read(step) + data
+    if not data:
+        return [], end_offset
+
+    has_trailing_newline = data.endswith(b'\n')
+    lines = data.split(b'\n')
+    if has_trailing_newline:
+        lines.pop()
+    if position > 0:
+        # first line is cut by block border
+        lines = lines[1:]
+    lines = lines[-count:] if count else []
+    lines_size = sum(len(line) + 1 for line in lines)
+    if lines and not has_trailing_newline:
+        lines_size -= 1
+    return [line.decode(errors='replace') for line in lines], end_offset - lines_size
+
+
+def skip_lines_after(segment_file, start_offset, count, block_size=READ_BLOCK_SIZE):
+    offset = start_offset
+    segment_file.seek(start_offset)
+    while count:
+        data = segment_file.read(block_size)
+        if not data:
+            break
+        position = 0
+        while count:
+            newline_position = data.find(b'\n', position)
+            if newline_position == -1:
+                position = len(data)
+                break
+            position = newline_position + 1
+            count -= 1
+        offset += position
+    return offset, count
+
+
+def read_lines_after(segment_file, start_offset, count):
+    segment_file.seek(start_offset)
+    lines = []
+    offset = start_offset
+    while len(lines) < count:
+        line = segment_file.readline()
+        if not line.endswith(b'\n'):
+            # line is not finished yet or segment is over
+            break
+        lines.append(line[:-1].decode(errors='replace'))
+        offset += len(line)
+    return lines, offset
+
+
+def parse_records(lines, first_sequence_number=None):
+    if first_sequence_number is None:
+        return [ChatMessage.from_record(line) for line in lines]
+    return [
+        ChatMessage.from_record(line, sequence_number)
+        for sequence_number, line in enumerate(lines, first_sequence_number)
+    ]
+
+
+def locate_message(history_log_path, sequence_number):
+    position = find_history_position(history_log_path, sequence_number=sequence_number)
+    if not position:
+        return None
+    number, offset, lines_to_skip = position
+    with open_segment(find_segment_path(history_log_path, number)) as segment_file:
+        offset, _ = skip_lines_after(segment_file, offset, lines_to_skip)
+    return number, offset
+
+
+def iterate_history(history_log_path, sequence_number=0):
+    """Yield stored messages starting from sequence_number."""
+    position = locate_message(history_log_path, sequence_number)
+    if not position:
+        return
+    number, offset = position
+    for segment_number in list_segments(history_log_path):
+        if segment_number < number:
+            continue
+        with open_segment(find_segment_path(history_log_path, segment_number)) as segment_file:
+            segment_file.seek(offset if segment_number == number else 0)
+            for line in segment_file:
+                if not line.endswith(b'\n'):
+                    return
+                yield ChatMessage.from_record(line[:-1].decode(errors='replace'), sequence_number)
+                sequence_number += 1
+
+
+def migrate_legacy_history(history_log_path):
+    legacy_path = os.path.join(history_log_path, LEGACY_HISTORY_FILE_NAME)
+    if not os.path.exists(legacy_path) or list_segments(history_log_path):
+        return
+    segment_path = get_segment_path(history_log_path, 1)
+    os.rename(legacy_path, segment_path)
+    modified_at = os.path.getmtime(segment_path)
+    with open(segment_path, 'rb') as segment_file:
+        lines_count = count_lines(segment_file, 0)
+        size = segment_file.seek(0, os.SEEK_END)
+    with open(get_index_path(history_log_path, 1), 'wb') as index_file:
+        index_file.write(INDEX_RECORD.pack(modified_at, 0, 0))
+        index_file.write(INDEX_RECORD.pack(modified_at, lines_count, size))
+
+
+def recover_segment_state(history_log_path):
+    migrate_legacy_history(history_log_path)
+    numbers = list_segments(history_log_path)
+    if not numbers:
+        return 1, 0, 0, None
+    number = numbers[-1]
+    index = read_index(get_index_path(history_log_path, number))
+    _, sequence_number, offset = (
+        INDEX_RECORD.unpack_from(index, len(index) - INDEX_RECORD.size) if index else (None, 0, 0)
+    )
+    segment_path = find_segment_path(history_log_path, number)
+    if segment_path != get_segment_path(history_log_path, number):
+        # segment is closed and compressed, its last record holds next sequence number
+        return number + 1, 0, sequence_number, None
+    with open(segment_path, 'rb') as segment_file:
+        sequence_number += count_lines(segment_file, offset)
+        size = segment_file.seek(0, os.SEEK_END)
+    first_record = read_first_index_record(history_log_path, number)
+    segment_day = date.fromtimestamp(first_record[0]) if first_record else None
+    return number, size, sequence_number, segment_day
+
+
+class HistoryLog:
+    def __init__(self, history_log_path, segment_size=DEFAULT_SEGMENT_SIZE, rotate_daily=False,
+                 compression=None, index_stride=DEFAULT_INDEX_STRIDE,
+                 write_batch=DEFAULT_WRITE_BATCH, write_latency=DEFAULT_WRITE_LATENCY,
+                 fsync_bytes=DEFAULT_FSYNC_BYTES, fsync_interval=DEFAULT_FSYNC_INTERVAL, search_index=None):
+        self.history_log_path = history_log_path
+        self.segment_size = segment_size
+        self.rotate_daily = rotate_daily
+        self.compression = compression
+        self.index_stride = index_stride
+        self.write_batch = write_batch
+        self.write_latency = write_latency
+        self.fsync_bytes = fsync_bytes
+        self.fsync_interval = fsync_interval
+        self.search_index = search_index
+
+        self.log_file = None
+        self.index_file = None
+        self.number = None
+        self.offset = 0
+        self.index_offset = 0
+        self.sequence_number = 0
+        self.segment_day = None
+        self.last_indexed_second = None
+        self.compressing = None
+        self.unsynced_bytes = 0
+        self.synced_at = time.monotonic()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def open(self):
+        loop = asyncio.get_event_loop()
+        self.number, self.offset, self.sequence_number, self.segment_day = await loop.run_in_executor(
+            None, recover_segment_state, self.history_log_path
+        )
+
+    async def close(self):
+        await self.sync()
+        await self._close_segment()
+        if self.compressing:
+            await self.compressing
+
+    async def write(self, messages):
+        started_at = time.monotonic()
+        now = time.time()
+        if self._is_rotation_needed(now):
+            await self._rotate(now)
+        if not self.log_file:
+            await self._open_segment()
+
+        # whole batch goes to disk with one write to segment and one write to index
+        first_sequence_number = self.sequence_number
+        chunks = []
+        records = []
+        offset = self.offset
+        for message in messages:
+            if self._is_index_needed(now, offset, self.sequence_number):
+                records.append(INDEX_RECORD.pack(now, self.sequence_number, offset))
+                self.last_indexed_second = int(now)
+            # number is line number in history, it differs from given one only if history queue dropped messages
+            message.sequence_number = self.sequence_number
+            data = f'{message.to_record()}\n'.encode()
+            chunks.append(data)
+            offset += len(data)
+            self.sequence_number += 1
+        data = b''.join(chunks)
+        await self.log_file.write(data, offset=self.offset)
+        if records:
+            await self._write_index(b''.join(records))
+        self.offset = offset
+        self.unsynced_bytes += len(data)
+
+        if self._is_fsync_needed():
+            await self._fsync()
+        if self.search_index:
+            self.search_index.add(first_sequence_number, messages)
+        metrics.inc('history_written_bytes', len(data))
+        metrics.inc('history_written_messages', len(messages))
+        metrics.observe('history_batch_size', len(messages))
+        metrics.observe('history_write_seconds', time.monotonic() - started_at)
+
+    def _is_rotation_needed(self, now):
+        if not self.offset:
+            return False
+        if self.segment_size and self.offset >= self.segment_size:
+            return True
+        return self.rotate_daily and self.segment_day != date.fromtimestamp(now)
+
+    def _is_index_needed(self, now, offset, sequence_number):
+        return (
+            not offset
+            or not sequence_number % self.index_stride
+            or int(now) != self.last_indexed_second
+        )
+
+    def get_fsync_delay(self):
+        """Seconds left before written data must be synced by time, None if nothing waits for it."""
+        if not self.fsync_interval or not self.unsynced_bytes:
+            return None
+        return max(0, self.synced_at + self.fsync_interval - time.monotonic())
+
+    async def sync(self):
+        if self.unsynced_bytes:
+            await self._fsync()
+
+    def _is_fsync_needed(self):
+        if self.fsync_bytes and self.unsynced_bytes >= self.fsync_bytes:
+            return True
+        return self.fsync_interval and time.monotonic() - self.synced_at >= self.fsync_interval
+
+    async def _fsync(self):
+        started_at = time.monotonic()
+        await self.log_file.fsync()
+        await self.index_file.fsync()
+        self.unsynced_bytes = 0
+        self.synced_at = time.monotonic()
+        metrics.inc('history_fsyncs')
+        metrics.observe('history_fsync_seconds', self.synced_at - started_at)
+
+    async def _write_index(self, records):
+        await self.index_file.write(records, offset=self.index_offset)
+        self.index_offset += len(records)
+
+    async def _open_segment(self):
+        index_path = get_index_path(self.history_log_path, self.number)
+        self.log_file = AIOFile(get_segment_path(self.history_log_path, self.number), 'ab')
+        self.index_file = AIOFile(index_path, 'ab')
+        await self.log_file.open()
+        await self.index_file.open()
+        self.index_offset = os.path.getsize(index_path)
+        if self.segment_day is None:
+            self.segment_day = date.today()
+
+    async def _close_segment(self):
+        if not self.log_file:
+            return
+        await self.log_file.close()
+        await self.index_file.close()
+        self.log_file = None
+        self.index_file = None
+
+    async def _rotate(self, now):
+        if not self.log_file:
+            await self._open_segment()
+        # closing record keeps next sequence number for the following segment
+        await self._write_index(INDEX_RECORD.pack(now, self.sequence_number, self.offset))
+        await self._fsync()
+        await self._close_segment()
+
+        if self.compression:
+            if self.compressing:
+                await self.compressing
+            loop = asyncio.get_event_loop()
+            self.compressing = loop.run_in_executor(
+                None, compress_segment, get_segment_path(self.history_log_path, self.number), self.compression
+            )
+        self.number += 1
+        self.offset = 0
+        self.segment_day = None
+
+
+class HistoryPager:
+    """Reads stored messages by sequence number for chat window, pager itself keeps no position."""
+
+    def __init__(self, history_log_path, display_rules=()):
+        self.history_log_path = history_log_path
+        # history keeps messages before display rules, they are applied again to read messages
+        self.display_rules = display_rules
+        self.segment = (None, None)
+
+    async def read_tail(self, count):
+        # records are parsed in executor too, loop thread gets ready messages
+        return await self._run(self._read_tail, count)
+
+    async def read_range(self, sequence_number, count):
+        return await self._run(self._read_range, sequence_number, count)
+
+    def _open_segment(self, number):
+        cached_number, segment_file = self.segment
+        if cached_number == number:
+            return segment_file
+        if segment_file:
+            segment_file.close()
+        # decompressed segment is kept too, user usually scrolls it further
+        segment_file = open_segment(find_segment_path(self.history_log_path, number))
+        self.segment = (number, segment_file)
+        return segment_file
+
+    def _read_tail(self, count):
+        numbers = list_segments(self.history_log_path)
+        if not numbers:
+            return []
+        lines = self._read_before(numbers[-1], None, count)
+        _, _, next_sequence_number, _ = recover_segment_state(self.history_log_path)
+        return apply_display_rules(self.display_rules, parse_records(lines, next_sequence_number - len(lines)))
+
+    def _read_before(self, number, offset, count):
+        numbers = [segment_number for segment_number in list_segments(self.history_log_path)
+                   if segment_number <= number]
+        lines = []
+        while numbers:
+            number = numbers.pop()
+            segment_lines, offset = read_lines_before(self._open_segment(number), offset, count - len(lines))
+            lines = segment_lines + lines
+            if offset or not numbers or len(lines) >= count:
+                break
+            offset = None
+        return lines
+
+    def _read_range(self, sequence_number, count):
+        position = find_history_position(self.history_log_path, sequence_number=sequence_number)
+        if not position:
+            return []
+        number, offset, lines_to_skip = position
+        offset, _ = skip_lines_after(self._open_segment(number), offset, lines_to_skip)
+        lines = []
+        for segment_number in list_segments(self.history_log_path):
+            if segment_number < number:
+                continue
+            segment_lines, _ = read_lines_after(
+                self._open_segment(segment_number), offset if segment_number == number else 0, count - len(lines)
+            )
+            lines.extend(segment_lines)
+            if len(lines) >= count:
+                break
+        return apply_display_rules(self.display_rules, parse_records(lines, sequence_number))
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
@@ -0,0 +1,66 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s %(message)s'
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_SAMPLE_RATE = 10
+
+
+class SampledLogger:
+    """Per-message debug log, at most `rate` records a second, the rest are only counted.
+
+    Disabled level costs one check, message is not even formatted.
+    """
+
+    rate = DEFAULT_LOG_SAMPLE_RATE
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+        self.second = None
+        self.records_count = 0
+        self.suppressed_count = 0
+
+    def is_enabled(self):
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def debug(self, msg, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        second = int(time.monotonic())
+        if second != self.second:
+            if self.suppressed_count:
+                self.logger.debug('%d similar records are suppressed', self.suppressed_count)
+            self.second = second
+            self.records_count = 0
+            self.suppressed_count = 0
+        if self.records_count >= self.rate:
+            self.suppressed_count += 1
+            return
+        self.records_count += 1
+        self.logger.debug(msg, *args)
+
+
+def setup_logging(level=DEFAULT_LOG_LEVEL, sample_rate=DEFAULT_LOG_SAMPLE_RATE, stream=None):
+    """Root logger only puts records to queue, formatting and writing happen in listener thread."""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    root_logger = logging.getLogger('')
+    root_logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(level)
+    SampledLogger.rate = sample_rate
+    listener.start()
+    # records left in queue are written on exit
+    atexit.register(listener.stop)
+    return listener
+
+
+def stop_logging(listener):
+    atexit.unregister(listener.stop)
+    listener.stop()
+    logging.getLogger('').handlers.clear()
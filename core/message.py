@@ -0,0 +1,59 @@
+import time
+
+AUTHOR_SEPARATOR = ': '
+RECORD_SEPARATOR = '\t'
+
+
+class ChatMessage:
+    """Chat line parsed once when it is received, every consumer gets the same object."""
+
+    __slots__ = ('timestamp', 'author', 'body', 'sequence_number', 'spans')
+
+    def __init__(self, timestamp, author, body, sequence_number=None):
+        self.timestamp = timestamp
+        self.author = author
+        self.body = body
+        self.sequence_number = sequence_number
+        # (start, end, tag) parts of body marked by message rules, not stored in history
+        self.spans = ()
+
+    def copy(self):
+        message = ChatMessage(self.timestamp, self.author, self.body, self.sequence_number)
+        message.spans = self.spans
+        return message
+
+    @classmethod
+    def from_line(cls, line, timestamp=None, sequence_number=None):
+        """Parse line as server sends it, 'author: body', lines of chat server have no author."""
+        author, separator, body = line.partition(AUTHOR_SEPARATOR)
+        if not separator:
+            author, body = '', line
+        return cls(timestamp, author, body, sequence_number)
+
+    @classmethod
+    def from_record(cls, record, sequence_number=None):
+        """Parse history log line, lines written before structured format are parsed as chat lines."""
+        timestamp, separator, rest = record.partition(RECORD_SEPARATOR)
+        if separator:
+            author, separator, body = rest.partition(RECORD_SEPARATOR)
+            try:
+                if separator:
+                    return cls(float(timestamp), author, body, sequence_number)
+            except ValueError:
+                pass
+        return cls.from_line(record, sequence_number=sequence_number)
+
+    def to_line(self):
+        if not self.author:
+            return self.body
+        return f'{self.author}{AUTHOR_SEPARATOR}{self.body}'
+
+    def to_record(self):
+        # body is the last field, so it may contain separator, author may not
+        author = self.author.replace(RECORD_SEPARATOR, ' ')
+        return f'{self.timestamp or 0:.3f}{RECORD_SEPARATOR}{author}{RECORD_SEPARATOR}{self.body}'
+
+    def format_time(self):
+        if not self.timestamp:
+            return ''
+        return time.strftime('%H:%M:%S', time.localtime(self.timestamp))
@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import json
+import logging
+import time
+from collections import defaultdict
+
+METRIC_NAME_PREFIX = 'minechat_'
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'max', 'bounds', 'buckets')
+
+    def __init__(self, bounds):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.bounds = bounds
+        # the last bucket is for values above all bounds
+        self.buckets = [0] * (len(bounds) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def quantile(self, fraction):
+        """Upper bound of bucket holding the quantile, max for values above all bounds."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.bounds, self.buckets):
+            seen += bucket_count
+            if seen >= rank and seen:
+                return bound
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = {}
+        # called before snapshot to refresh gauges, e.g. queue depths
+        self.collectors = []
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            # durations are in seconds, everything else is sizes and counts
+            histogram = Histogram(LATENCY_BUCKETS if name.endswith('_seconds') else SIZE_BUCKETS)
+            self.histograms[name] = histogram
+        histogram.observe(value)
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector()
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {
+                name: {
+                    'count': histogram.count,
+                    'mean': histogram.mean,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                    'max': histogram.max,
+                }
+                for name, histogram in self.histograms.items()
+            },
+        }
+
+
+def create_cpu_collector():
+    previous_cpu_time = time.process_time()
+    previous_time = time.monotonic()
+
+    def collect_cpu_usage():
+        nonlocal previous_cpu_time, previous_time
+        cpu_time = time.process_time()
+        now = time.monotonic()
+        if now > previous_time:
+            metrics.set('process_cpu_percent', round(100 * (cpu_time - previous_cpu_time) / (now - previous_time), 1))
+        previous_cpu_time, previous_time = cpu_time, now
+
+    return collect_cpu_usage
+
+
+metrics = Metrics()
+metrics.add_collector(create_cpu_collector())
+
+
+async def log_metrics(interval):
+    logger = logging.getLogger('metrics_logger')
+    previous_counters = dict(metrics.counters)
+    previous_time = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        elapsed = now - previous_time
+        rates = {
+            name: round((value - previous_counters.get(name, 0)) / elapsed, 2)
+            for name, value in metrics.counters.items()
+        }
+        previous_counters = dict(metrics.counters)
+        previous_time = now
+        snapshot = metrics.snapshot()
+        logger.info(f'per sec: {rates} gauges: {snapshot["gauges"]} histograms: {snapshot["histograms"]}')
+
+
+def format_prometheus():
+    for collector in metrics.collectors:
+        collector()
+    lines = []
+    for name, value in sorted(metrics.counters.items()):
+        lines.extend((f'# TYPE {METRIC_NAME_PREFIX}{name}_total counter', f'{METRIC_NAME_PREFIX}{name}_total {value}'))
+    for name, value in sorted(metrics.gauges.items()):
+        lines.extend((f'# TYPE {METRIC_NAME_PREFIX}{name} gauge', f'{METRIC_NAME_PREFIX}{name} {value}'))
+    for name, histogram in sorted(metrics.histograms.items()):
+        name = f'{METRIC_NAME_PREFIX}{name}'
+        lines.append(f'# TYPE {name} histogram')
+        cumulative_count = 0
+        for bound, bucket_count in zip(histogram.bounds, histogram.buckets):
+            cumulative_count += bucket_count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative_count}')
+        lines.extend((
+            f'{name}_bucket{{le="+Inf"}} {histogram.count}',
+            f'{name}_sum {histogram.total}',
+            f'{name}_count {histogram.count}',
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # headers are not needed, they are only read out
+        while (await reader.readline()).strip():
+            pass
+        _, path, *_ = request_line.decode(errors='replace').split() or ('', '')
+        if path.endswith('.json'):
+            body, content_type = json.dumps(metrics.snapshot()), 'application/json'
+        else:
+            body, content_type = format_prometheus(), 'text/plain; version=0.0.4'
+        body = body.encode()
+        writer.write(
+            f'HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+            + body
+        )
+        await writer.drain()
+    except (ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(port, host='127.0.0.1'):
+    """Serve Prometheus text on any path, JSON snapshot on paths ending with .json."""
+    server = await asyncio.start_server(handle_metrics_request, host, port)
+    logging.info(f'metrics are served on http://{host}:{port}/metrics')
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,87 @@
+import asyncio
+from enum import Enum
+
+from core.metrics import metrics
+
+
+class OverflowPolicy(Enum):
+    # producer waits for free place
+    BLOCK = 'block'
+    # oldest waiting item is thrown away
+    DROP_OLDEST = 'drop_oldest'
+    # waiting item of the same type is replaced by new one, else oldest is thrown away
+    COALESCE = 'coalesce'
+
+    def __str__(self):
+        return str(self.value)
+
+
+DEFAULT_QUEUES = {
+    'messages': (10000, OverflowPolicy.DROP_OLDEST),
+    'history': (100000, OverflowPolicy.BLOCK),
+    'sending': (1000, OverflowPolicy.BLOCK),
+    'status': (100, OverflowPolicy.COALESCE),
+}
+
+
+class QueuesConfigError(Exception):
+    pass
+
+
+class BoundedQueue(asyncio.Queue):
+    def __init__(self, name, maxsize, policy=OverflowPolicy.BLOCK):
+        super().__init__(maxsize)
+        self.name = name
+        self.policy = policy
+        metrics.add_collector(lambda: metrics.set(f'queue_{self.name}_depth', self.qsize()))
+
+    async def put(self, item):
+        if self.policy is not OverflowPolicy.BLOCK:
+            return self.put_nowait(item)
+        if self.full():
+            metrics.inc(f'queue_{self.name}_blocked')
+        await super().put(item)
+
+    def put_nowait(self, item):
+        if self.full():
+            if self.policy is OverflowPolicy.BLOCK:
+                raise asyncio.QueueFull()
+            if self.policy is OverflowPolicy.COALESCE and self._replace_same_type(item):
+                metrics.inc(f'queue_{self.name}_coalesced')
+                return
+            self.get_nowait()
+            self.task_done()
+            metrics.inc(f'queue_{self.name}_dropped')
+        super().put_nowait(item)
+
+    def _replace_same_type(self, item):
+        for position in reversed(range(len(self._queue))):
+            if type(self._queue[position]) is type(item):
+                self._queue[position] = item
+                return True
+        return False
+
+
+def parse_queues_config(config):
+    """Parse 'name=size:policy,...' over default queues settings."""
+    queues_config = dict(DEFAULT_QUEUES)
+    for queue_config in filter(None, (config or '').split(',')):
+        try:
+            name, settings = queue_config.strip().split('=')
+            size, _, policy = settings.partition(':')
+            default_size, default_policy = queues_config[name]
+            queues_config[name] = (
+                int(size) if size else default_size,
+                OverflowPolicy(policy) if policy else default_policy
+            )
+        except (KeyError, ValueError):
+            raise QueuesConfigError(f'wrong queue settings {queue_config}')
+    return queues_config
+
+
+def create_queues(queues_config, prefix=''):
+    # prefix keeps metrics of queues of different rooms apart
+    return {
+        name: BoundedQueue(f'{prefix}{name}', size, policy)
+        for name, (size, policy) in queues_config.items()
+    }
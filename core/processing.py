@@ -0,0 +1,193 @@
+import asyncio
+import concurrent.futures
+import importlib
+import logging
+import multiprocessing
+import re
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from core.metrics import metrics
+
+PROCESSING_POOLS = ('thread', 'process')
+DEFAULT_PROCESSING_WORKERS = 2
+DEFAULT_PROCESSING_BATCH = 100
+LINK_PATTERN = re.compile(r'https?://\S+')
+
+
+class RulesConfigError(Exception):
+    pass
+
+
+def extract_links(message):
+    message.spans += tuple(
+        (match.start(), match.end(), 'message_link') for match in LINK_PATTERN.finditer(message.body)
+    )
+    return message
+
+
+class HighlightRule:
+    """Marks parts of body matching regex, e.g. own nickname."""
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+
+    def __call__(self, message):
+        message.spans += tuple(
+            (match.start(), match.end(), 'message_highlight')
+            for match in self.pattern.finditer(message.body) if match.end() > match.start()
+        )
+        return message
+
+
+class MaskRule:
+    """Replaces listed words with asterisks of the same length, so marks of other rules stay in place."""
+
+    def __init__(self, words):
+        self.pattern = re.compile(r'\b(?:{})\b'.format('|'.join(map(re.escape, words))), re.IGNORECASE)
+
+    def __call__(self, message):
+        message.body = self.pattern.sub(lambda match: '*' * len(match.group()), message.body)
+        return message
+
+
+def split_config(config):
+    return [item.strip() for item in (config or '').split(',') if item.strip()]
+
+
+def load_rules(rules_config, highlight_pattern=None, mask_words_config=None, mask_history=False):
+    """Parse 'links,highlight,mask,package.module:function' into stored and display rules.
+
+    Stored rules run before history log, own `package.module:function` rule returns changed message
+    or None to drop it. Display rules only change what is shown, they run again on messages read from history.
+    Mask is display rule unless mask_history is set.
+    """
+    rules = []
+    display_rules = []
+    mask_words = split_config(mask_words_config)
+    for rule_name in split_config(rules_config):
+        if rule_name == 'links':
+            display_rules.append(extract_links)
+        elif rule_name == 'highlight':
+            if not highlight_pattern:
+                raise RulesConfigError('highlight rule requires highlight pattern')
+            try:
+                display_rules.append(HighlightRule(highlight_pattern))
+            except re.error as error:
+                raise RulesConfigError(f'wrong highlight pattern: {error}')
+        elif rule_name == 'mask':
+            if not mask_words:
+                raise RulesConfigError('mask rule requires mask words')
+            (rules if mask_history else display_rules).append(MaskRule(mask_words))
+        else:
+            module_name, _, function_name = rule_name.partition(':')
+            if not function_name:
+                raise RulesConfigError(f'unknown message rule {rule_name}')
+            try:
+                rules.append(getattr(importlib.import_module(module_name), function_name))
+            except (ImportError, AttributeError) as error:
+                raise RulesConfigError(f'message rule {rule_name} is not loaded: {error!r}')
+    return rules, display_rules
+
+
+def report_rule_errors(errors):
+    for error in errors:
+        logging.warning(f'message rule failed, message is kept unchanged: {error}')
+    metrics.inc('processing_rule_errors', len(errors))
+
+
+def run_rules(rules, message, errors):
+    # rules get a copy, so message failed in the middle of rules goes on as it was received
+    processed_message = message.copy()
+    try:
+        for rule in rules:
+            processed_message = rule(processed_message)
+            if processed_message is None:
+                return None
+    except Exception as error:
+        errors.append(f'{message.to_line()!r}: {error!r}')
+        return message
+    return processed_message
+
+
+def apply_display_rules(display_rules, messages, errors=None):
+    if not display_rules:
+        return messages
+    rule_errors = [] if errors is None else errors
+    # stored message is not changed, history keeps it as it is
+    shown_messages = [run_rules(display_rules, message, rule_errors) for message in messages]
+    if errors is None:
+        report_rule_errors(rule_errors)
+    return shown_messages
+
+
+def apply_rules(rules, display_rules, messages):
+    """Return (stored, shown) pairs and errors of failed rules, errors are reported by caller."""
+    # runs in worker thread or process, rules see messages one by one in received order
+    errors = []
+    stored_messages = messages
+    if rules:
+        stored_messages = [
+            stored_message for stored_message in (run_rules(rules, message, errors) for message in messages)
+            if stored_message is not None
+        ]
+    shown_messages = apply_display_rules(display_rules, stored_messages, errors)
+    return list(zip(stored_messages, shown_messages)), errors
+
+
+def get_process_context():
+    # fork of process with running tk, log and search threads may leave workers with locked locks
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(start_method)
+
+
+class MessageProcessor:
+    """Runs message rules in thread or process pool, so heavy rules do not hold event loop.
+
+    Received batch is split between workers, parts are joined back in received order.
+    Every message left after stored rules is returned as (stored, shown) pair.
+    Failed rule keeps its message unchanged, died process pool is started again.
+    """
+
+    def __init__(self, rules, display_rules=(), pool='thread', workers=DEFAULT_PROCESSING_WORKERS,
+                 max_batch=DEFAULT_PROCESSING_BATCH):
+        self.rules = rules
+        self.display_rules = display_rules
+        self.pool = pool
+        self.workers = workers
+        self.max_batch = max_batch
+        self.executor = self.create_executor()
+
+    def create_executor(self):
+        if self.pool == 'process':
+            return concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=get_process_context())
+        return concurrent.futures.ThreadPoolExecutor(self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=False)
+
+    async def process(self, messages):
+        loop = asyncio.get_event_loop()
+        started_at = time.perf_counter()
+        try:
+            parts = await asyncio.gather(*[
+                loop.run_in_executor(
+                    self.executor, apply_rules, self.rules, self.display_rules, messages[start:start + self.max_batch]
+                )
+                for start in range(0, len(messages), self.max_batch)
+            ])
+        except BrokenProcessPool as error:
+            # worker died on this batch, so it goes on unprocessed and next batches get new workers
+            logging.warning(f'processing pool is broken, it is started again: {error!r}')
+            metrics.inc('processing_pool_restarts')
+            self.executor.shutdown(wait=False)
+            self.executor = self.create_executor()
+            parts = [([(message, message) for message in messages], [])]
+        report_rule_errors([error for _, errors in parts for error in errors])
+        processed_messages = [message for part, _ in parts for message in part]
+        metrics.observe('processing_seconds', time.perf_counter() - started_at)
+        metrics.inc('processing_dropped_messages', len(messages) - len(processed_messages))
+        return processed_messages
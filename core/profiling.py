@@ -0,0 +1,109 @@
+import asyncio
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+
+from core.metrics import metrics
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+
+def get_callback_name(handle):
+    callback = handle._callback
+    # steps of one task are counted together by its coroutine
+    task = getattr(callback, '__self__', None)
+    if isinstance(task, asyncio.Task):
+        # Task.get_coro is added in python 3.8
+        get_coro = getattr(task, 'get_coro', None)
+        coroutine = get_coro() if get_coro else task._coro
+        return getattr(coroutine, '__qualname__', repr(coroutine))
+    return getattr(callback, '__qualname__', repr(callback))
+
+
+class LoopTimer:
+    """Time of every event loop callback, long callback blocks the whole client."""
+
+    def __init__(self):
+        # name: [calls count, total seconds, max seconds]
+        self.callbacks = defaultdict(lambda: [0, 0, 0])
+        self.original_run = None
+
+    def install(self):
+        self.original_run = asyncio.events.Handle._run
+        original_run = self.original_run
+
+        def run(handle):
+            started_at = time.perf_counter()
+            try:
+                original_run(handle)
+            finally:
+                self.record(handle, time.perf_counter() - started_at)
+
+        asyncio.events.Handle._run = run
+
+    def uninstall(self):
+        if self.original_run:
+            asyncio.events.Handle._run = self.original_run
+            self.original_run = None
+
+    def record(self, handle, duration):
+        metrics.observe('loop_callback_seconds', duration)
+        timing = self.callbacks[get_callback_name(handle)]
+        timing[0] += 1
+        timing[1] += duration
+        if duration > timing[2]:
+            timing[2] = duration
+
+    def dump(self, path):
+        timings = [
+            {'name': name, 'calls': calls, 'total_seconds': total, 'max_seconds': max_duration}
+            for name, (calls, total, max_duration) in self.callbacks.items()
+        ]
+        timings.sort(key=lambda timing: timing['total_seconds'], reverse=True)
+        with open(path, 'w') as timings_file:
+            json.dump(timings, timings_file, indent=2)
+
+
+def start_profiler():
+    if yappi:
+        # yappi sees every thread, window thread of thread gui mode too
+        yappi.set_clock_type('cpu')
+        yappi.start()
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler, path):
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(path)
+        return
+    yappi.stop()
+    yappi.get_func_stats().save(path, type='pstat')
+    yappi.clear_stats()
+
+
+@contextlib.contextmanager
+def profile_run(profile_dir_path, name):
+    """Write pstats profile and loop callback timings to profile dir when run is over."""
+    os.makedirs(profile_dir_path, exist_ok=True)
+    file_prefix = os.path.join(profile_dir_path, f'{name}-{os.getpid()}')
+    loop_timer = LoopTimer()
+    loop_timer.install()
+    profiler = start_profiler()
+    try:
+        yield
+    finally:
+        stop_profiler(profiler, f'{file_prefix}.prof')
+        loop_timer.uninstall()
+        loop_timer.dump(f'{file_prefix}-loop.json')
+        logging.info(f'profile is saved to {file_prefix}.prof and {file_prefix}-loop.json')
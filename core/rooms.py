@@ -0,0 +1,46 @@
+import os
+
+
+class RoomsConfigError(Exception):
+    pass
+
+
+class Room:
+    """One chat server or room in the window: its connection pair, queues, history and outbound spool.
+
+    Queues, history and spool are set by the client when room is opened.
+    """
+
+    def __init__(self, name, host, read_port, send_port, token=None, history_log_path=None):
+        self.name = name
+        self.host = host
+        self.read_port = read_port
+        self.send_port = send_port
+        self.token = token
+        self.history_log_path = history_log_path
+        self.messages_queue = None
+        self.history_queue = None
+        self.status_updates_queue = None
+        self.sending_spool = None
+        self.history_log = None
+        self.history_pager = None
+        self.search_index = None
+
+
+def parse_rooms_config(config, history_log_path):
+    """Parse 'name=host:read_port:send_port[:token],...', history of every room is kept in its own folder."""
+    rooms = []
+    for room_config in filter(None, (config or '').split(',')):
+        try:
+            name, settings = room_config.strip().split('=')
+            host, read_port, send_port, *token = settings.split(':')
+            if not name or os.sep in name or not host or len(token) > 1:
+                raise ValueError()
+            rooms.append(Room(name, host, int(read_port), int(send_port), token[0] if token else None,
+                              os.path.join(history_log_path, name)))
+        except ValueError:
+            raise RoomsConfigError(f'wrong room settings {room_config}')
+    names = [room.name for room in rooms]
+    if len(set(names)) != len(names):
+        raise RoomsConfigError('rooms have repeated names')
+    return rooms
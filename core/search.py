@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from core.history import iterate_history
+from core.metrics import metrics
+
+SEARCH_INDEX_FILE_NAME = 'history_search.sqlite3'
+CATCH_UP_BATCH = 10000
+
+
+class SearchIndexUnavailable(Exception):
+    pass
+
+
+def log_search_index_error(future):
+    if future.exception():
+        logging.error(f'search index update failed: {future.exception()!r}')
+
+
+def make_match_query(text):
+    # every word is quoted, so user input is never parsed as fts5 syntax
+    words = [word.replace('"', '""') for word in text.split()]
+    return ' '.join(f'"{word}"' for word in words)
+
+
+class SearchIndex:
+    def __init__(self, history_log_path):
+        self.history_log_path = history_log_path
+        self.connection = None
+        self.last_sequence_number = -1
+        # sqlite connection lives in one thread, tasks are done in order;
+        # daemon thread does not hold app exit while long catch up is running
+        self.tasks = queue.Queue()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+
+    async def open(self):
+        self.worker.start()
+        await asyncio.wrap_future(self._submit(self._connect))
+        # history written without index is indexed in background
+        self._submit(self._catch_up).add_done_callback(log_search_index_error)
+
+    def add(self, first_sequence_number, messages):
+        self._submit(self._add, first_sequence_number, messages).add_done_callback(log_search_index_error)
+
+    async def search(self, text, limit=50):
+        query = make_match_query(text)
+        if not query:
+            return []
+        return await asyncio.wrap_future(self._submit(self._search, query, limit))
+
+    def _submit(self, func, *args):
+        future = Future()
+        self.tasks.put((func, args, future))
+        return future
+
+    def _work(self):
+        while True:
+            func, args, future = self.tasks.get()
+            try:
+                future.set_result(func(*args))
+            except Exception as error:
+                future.set_exception(error)
+
+    def _connect(self):
+        self.connection = sqlite3.connect(os.path.join(self.history_log_path, SEARCH_INDEX_FILE_NAME))
+        try:
+            self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(body)')
+        except sqlite3.OperationalError as error:
+            raise SearchIndexUnavailable(str(error))
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        last_sequence_number, = self.connection.execute('SELECT max(rowid) FROM messages').fetchone()
+        if last_sequence_number is not None:
+            self.last_sequence_number = last_sequence_number
+
+    def _add(self, first_sequence_number, messages):
+        rows = [
+            (sequence_number, message.to_line())
+            for sequence_number, message in enumerate(messages, first_sequence_number)
+            if sequence_number > self.last_sequence_number
+        ]
+        if not rows:
+            return
+        with self.connection:
+            self.connection.executemany('INSERT INTO messages(rowid, body) VALUES (?, ?)', rows)
+        self.last_sequence_number = rows[-1][0]
+        metrics.inc('search_indexed_messages', len(rows))
+
+    def _catch_up(self):
+        messages = []
+        for message in iterate_history(self.history_log_path, self.last_sequence_number + 1):
+            messages.append(message)
+            if len(messages) >= CATCH_UP_BATCH:
+                self._add(messages[0].sequence_number, messages)
+                messages = []
+        if messages:
+            self._add(messages[0].sequence_number, messages)
+        logging.debug(f'search index is up to date, last message {self.last_sequence_number}')
+
+    def _search(self, query, limit):
+        return self.connection.execute(
+            'SELECT rowid, body FROM messages WHERE messages MATCH ? ORDER BY rowid DESC LIMIT ?',
+            (query, limit)
+        ).fetchall()
@@ -0,0 +1,215 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import socket
+import time
+
+import aionursery
+
+from core.chat_reader import DEFAULT_REPLAY_WINDOW, ReplayFilter, read_stream_chat, save_messages
+from core.chat_tool import (
+    DEFAULT_BACKOFF_BASE,
+    DEFAULT_BACKOFF_MAX,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_MAX_LINE_LENGTH,
+    DEFAULT_STABLE_CONNECTION_SECONDS,
+    Backoff,
+    LineFramer,
+    ReadConnectionStateChanged,
+    SendingConnectionStateChanged,
+    send_watchdog_messages,
+    NicknameReceived,
+    get_open_connection_tools,
+    use_open_connection
+)
+from core.chat_writer import DEFAULT_SEND_BATCH, ChatCredentials, log_in, write_stream_chat
+from core.history import HistoryPager
+from core.metrics import metrics
+from core.spool import DEFAULT_ACK_TIMEOUT, watch_for_echo
+from core.watchdog import ConnectionLiveness, watch_for_connection
+
+
+@contextlib.asynccontextmanager
+async def create_handy_nursery():
+    try:
+        async with aionursery.Nursery() as nursery:
+            yield nursery
+    except aionursery.MultiError as e:
+        if len(e.exceptions) == 1:
+            raise e.exceptions[0]
+        raise
+
+
+async def read_connection(reader, messages_queue, history_queue, liveness, replay_filter, sending_spool,
+                          sequence_numbers, watchdog_timeout=5, watchdog_debug=False,
+                          max_line_length=DEFAULT_MAX_LINE_LENGTH, oversize_policy='truncate', message_processor=None,
+                          recent_lines_loaded=None):
+    if recent_lines_loaded:
+        # connection is opened while history tail is loaded, received messages go after the tail
+        await recent_lines_loaded.wait()
+    # server sends recent messages first, they are already stored if it is reconnect
+    replay_filter.resume()
+    # silence counts from connection start, not from the previous connection
+    liveness.touch('read')
+    async with create_handy_nursery() as nursery:
+        nursery.start_soon(
+            read_stream_chat(reader, messages_queue, history_queue, liveness, replay_filter, sending_spool,
+                             LineFramer(max_line_length, oversize_policy), sequence_numbers, message_processor)
+        )
+        # activity on send connection shows server is alive too, quiet chat is not a failure
+        nursery.start_soon(
+            watch_for_connection(liveness, watchdog_timeout, debug=watchdog_debug)
+        )
+
+
+async def send_connection(writer, reader, liveness, sending_spool, status_updates_queue, credentials,
+                          send_max_batch=DEFAULT_SEND_BATCH, watchdog_timeout=5, watchdog_debug=False,
+                          ack_timeout=DEFAULT_ACK_TIMEOUT, logged_in=False):
+    if not logged_in:
+        await log_in(reader, writer, credentials, liveness)
+        msg = f'Выполнена авторизация. Пользователь {credentials.nickname}.'
+        logging.debug(msg)
+    status_updates_queue.put_nowait(NicknameReceived(credentials.nickname))
+    # echo of sent message on read connection starts with nickname
+    sending_spool.nickname = credentials.nickname
+    async with create_handy_nursery() as nursery:
+        nursery.start_soon(
+            write_stream_chat(writer, sending_spool, liveness, send_max_batch)
+        )
+        nursery.start_soon(
+            watch_for_echo(sending_spool, ack_timeout)
+        )
+        nursery.start_soon(
+            send_watchdog_messages(writer, reader, liveness)
+        )
+        nursery.start_soon(
+            watch_for_connection(liveness, watchdog_timeout, debug=watchdog_debug, connection_names=('send',))
+        )
+
+
+async def supervise_connection(name, host, port, attempts, status_changed, status_updates_queue,
+                               run_connection, rate_limiter=None, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                               backoff=None, opened_connection=None,
+                               stable_connection_seconds=DEFAULT_STABLE_CONNECTION_SECONDS):
+    """Keep one connection open, when it fails only this connection is opened again."""
+    backoff = backoff or Backoff()
+    disconnected_at = None
+    while True:
+        established_at = None
+        status_updates_queue.put_nowait(status_changed.INITIATED)
+        try:
+            if opened_connection:
+                # connection given by caller is used once, reconnects open new ones
+                connecting, opened_connection = use_open_connection(*opened_connection), None
+            else:
+                if rate_limiter:
+                    await rate_limiter.acquire()
+                connecting = get_open_connection_tools(host, port, attempts, connect_timeout, backoff)
+            async with connecting as (reader, writer):
+                status_updates_queue.put_nowait(status_changed.ESTABLISHED)
+                established_at = time.monotonic()
+                if disconnected_at is not None:
+                    metrics.inc('reconnects')
+                    metrics.inc(f'{name}_reconnects')
+                    metrics.observe('reconnect_seconds', time.monotonic() - disconnected_at)
+                    disconnected_at = None
+                await run_connection(reader, writer)
+        except (
+                socket.gaierror,
+                ConnectionRefusedError,
+                ConnectionResetError,
+                ConnectionError,
+        ) as error:
+            logging.debug(f'{name} connection is closed: {error!r}')
+            if disconnected_at is None:
+                disconnected_at = time.monotonic()
+            status_updates_queue.put_nowait(status_changed.CLOSED)
+            if established_at is None:
+                # failed connect attempts have already waited their delays
+                continue
+            # server which accepts and drops connection at once is not reconnected in a busy loop
+            if time.monotonic() - established_at >= stable_connection_seconds:
+                backoff.reset()
+            await asyncio.sleep(backoff.get_delay())
+            continue
+        break
+
+
+async def remember_recent_lines(replay_filter, recent_lines, recent_lines_loaded):
+    replay_filter.remember_lines(await recent_lines)
+    recent_lines_loaded.set()
+
+
+async def handle_connection(host, read_port, send_port, messages_queue, history_queue, sending_spool,
+                            status_updates_queue, token, attempts,
+                            history_log, watchdog_timeout=5, watchdog_debug=False,
+                            send_max_batch=DEFAULT_SEND_BATCH, rate_limiter=None,
+                            connect_timeout=DEFAULT_CONNECT_TIMEOUT, backoff_base=DEFAULT_BACKOFF_BASE,
+                            backoff_max=DEFAULT_BACKOFF_MAX, recent_lines=None, ack_timeout=DEFAULT_ACK_TIMEOUT,
+                            max_line_length=DEFAULT_MAX_LINE_LENGTH, oversize_policy='truncate',
+                            credentials=None, registered_connection=None,
+                            replay_window=DEFAULT_REPLAY_WINDOW, message_processor=None):
+    # messages_queue and history_queue may be None when nobody consumes them,
+    # InvalidToken is left for the caller: window shows message box, headless session logs it.
+    # recent_lines are last stored messages, server replay of them is not stored twice,
+    # by default they are read from history log, so restart does not store the replay again;
+    # future of them lets connections open while the caller loads history, reading waits for it,
+    # messages changed or dropped by own stored rules are not found there and their replay is stored again.
+    # sending_spool is opened by the caller, so messages typed before connection are kept.
+    # registered_connection is (reader, writer) of just registered user, it becomes the first send connection
+    # message_processor runs message rules in worker pool, it is shared by sessions and closed by the caller
+    credentials = credentials or ChatCredentials(token)
+    liveness = ConnectionLiveness(('read', 'send'))
+    connection_settings = {
+        'rate_limiter': rate_limiter,
+        'connect_timeout': connect_timeout,
+    }
+    async with contextlib.AsyncExitStack() as stack:
+        sequence_numbers = itertools.count()
+        if history_log:
+            await stack.enter_async_context(history_log)
+            # numbers of received messages go on from stored history
+            sequence_numbers = itertools.count(history_log.sequence_number)
+            if recent_lines is None:
+                history = await HistoryPager(history_log.history_log_path).read_tail(replay_window)
+                recent_lines = [message.to_line() for message in history]
+        recent_lines_loaded = asyncio.Event()
+        is_loading = asyncio.isfuture(recent_lines)
+        replay_filter = ReplayFilter(() if is_loading else recent_lines or (), replay_window)
+        nursery = await stack.enter_async_context(create_handy_nursery())
+        if is_loading:
+            nursery.start_soon(remember_recent_lines(replay_filter, recent_lines, recent_lines_loaded))
+        else:
+            recent_lines_loaded.set()
+        # read and send connections are reopened independently, reader keeps working while sender reconnects
+        nursery.start_soon(
+            supervise_connection(
+                'read', host, read_port, attempts, ReadConnectionStateChanged, status_updates_queue,
+                lambda reader, _: read_connection(
+                    reader, messages_queue, history_queue, liveness, replay_filter, sending_spool,
+                    sequence_numbers, watchdog_timeout, watchdog_debug, max_line_length, oversize_policy,
+                    message_processor, recent_lines_loaded
+                ),
+                backoff=Backoff(backoff_base, backoff_max), **connection_settings
+            )
+        )
+        nursery.start_soon(
+            supervise_connection(
+                'send', host, send_port, attempts, SendingConnectionStateChanged, status_updates_queue,
+                lambda reader, writer: send_connection(
+                    writer, reader, liveness, sending_spool, status_updates_queue, credentials,
+                    send_max_batch, watchdog_timeout, watchdog_debug, ack_timeout,
+                    logged_in=bool(registered_connection) and writer is registered_connection[1]
+                ),
+                backoff=Backoff(backoff_base, backoff_max), opened_connection=registered_connection,
+                **connection_settings
+            )
+        )
+        nursery.start_soon(
+            sending_spool.save_entries()
+        )
+        if history_log:
+            nursery.start_soon(
+                save_messages(history_log, history_queue)
+            )
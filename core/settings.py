@@ -0,0 +1,188 @@
+import contextlib
+import logging
+import os
+import sys
+
+from core.chat_tool import (
+    DEFAULT_BACKOFF_BASE,
+    DEFAULT_BACKOFF_MAX,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_MAX_LINE_LENGTH,
+    OVERSIZE_POLICIES
+)
+from core.chat_writer import DEFAULT_SEND_BATCH
+from core.logs import DEFAULT_LOG_LEVEL, DEFAULT_LOG_SAMPLE_RATE, LOG_LEVELS
+from core.metrics import log_metrics, serve_metrics
+from core.processing import (
+    DEFAULT_PROCESSING_WORKERS,
+    PROCESSING_POOLS,
+    MessageProcessor,
+    RulesConfigError,
+    load_rules
+)
+from core.spool import DEFAULT_ACK_TIMEOUT
+
+
+def add_common_arguments(parser):
+    """Arguments of chat server, connections, message rules, logs and metrics, the same for window and headless."""
+    parser.add_argument('--host', required=False,
+                        help='chat host',
+                        type=str)
+    parser.add_argument('--read_port', required=False,
+                        help='chat port for reading messages',
+                        type=int)
+    parser.add_argument('--send_port', required=False,
+                        help='chat port for sending messages',
+                        type=int)
+    parser.add_argument('--attempts', required=False,
+                        help='connect attempts before connection is reported closed',
+                        type=str)
+    parser.add_argument('--connect_timeout', required=False,
+                        help='seconds to wait for connection to open',
+                        type=float)
+    parser.add_argument('--backoff_base', required=False,
+                        help='first delay in seconds between connect attempts, doubled after every failure',
+                        type=float)
+    parser.add_argument('--backoff_max', required=False,
+                        help='max delay in seconds between connect attempts',
+                        type=float)
+    parser.add_argument('--max_line_length', required=False,
+                        help='longer received lines are truncated or skipped',
+                        type=int)
+    parser.add_argument('--oversize_lines', required=False,
+                        help='what to do with too long received lines',
+                        choices=OVERSIZE_POLICIES)
+    parser.add_argument('--ack_timeout', required=False,
+                        help='seconds to wait for sent message in chat before it is sent again',
+                        type=float)
+    parser.add_argument('--watchdog_timeout', required=False,
+                        help='seconds without connection activity before reconnect',
+                        type=float)
+    parser.add_argument('--send_batch', required=False,
+                        help='max messages sent with one write',
+                        type=int)
+    parser.add_argument('--metrics_interval', required=False,
+                        help='seconds between metrics log lines, 0 - disabled',
+                        type=float)
+    parser.add_argument('--metrics_port', required=False,
+                        help='localhost port for Prometheus text and JSON metrics, 0 - disabled',
+                        type=int)
+    parser.add_argument('--profile', required=False,
+                        help='save cProfile/yappi stats and event loop callback timings on exit',
+                        action='store_true')
+    parser.add_argument('--message_rules', required=False,
+                        help='rules for received messages: links, highlight, mask or package.module:function',
+                        type=str)
+    parser.add_argument('--highlight', required=False,
+                        help='regex of message parts marked by highlight rule',
+                        type=str)
+    parser.add_argument('--mask_words', required=False,
+                        help='comma separated words hidden by mask rule',
+                        type=str)
+    parser.add_argument('--mask_history', required=False,
+                        help='store messages in history after mask rule, original text is not kept',
+                        action='store_true')
+    parser.add_argument('--processing_pool', required=False,
+                        help='thread or process pool where message rules run',
+                        choices=PROCESSING_POOLS)
+    parser.add_argument('--processing_workers', required=False,
+                        help='workers of message rules pool',
+                        type=int)
+    parser.add_argument('--log_level', required=False,
+                        help='lowest level of written log records',
+                        choices=LOG_LEVELS)
+    parser.add_argument('--log_sample_rate', required=False,
+                        help='max per-message debug records a second',
+                        type=int)
+
+
+def read_log_settings(user_arguments):
+    log_level = user_arguments.log_level or os.getenv('LOG_LEVEL', DEFAULT_LOG_LEVEL).upper()
+    if log_level not in LOG_LEVELS:
+        logging.error(f'unknown log level {log_level}')
+        sys.exit(2)
+    log_sample_rate = int(user_arguments.log_sample_rate or os.getenv('LOG_SAMPLE_RATE', DEFAULT_LOG_SAMPLE_RATE))
+    return log_level, log_sample_rate
+
+
+def read_server_settings(user_arguments):
+    host = user_arguments.host or os.getenv('HOST', 'minechat.dvmn.org')
+    read_port = user_arguments.read_port or os.getenv('READ_PORT', 5000)
+    send_port = user_arguments.send_port or os.getenv('SEND_PORT', 5050)
+    return host, read_port, send_port
+
+
+def read_connection_settings(user_arguments):
+    """Settings given to every chat session as keyword arguments of handle_connection."""
+    oversize_policy = user_arguments.oversize_lines or os.getenv('OVERSIZE_LINES', 'truncate')
+    if oversize_policy not in OVERSIZE_POLICIES:
+        logging.error(f'unknown oversize lines policy {oversize_policy}')
+        sys.exit(2)
+    return {
+        'attempts': int(user_arguments.attempts or os.getenv('ATTEMPTS_COUNT', 3)),
+        'connect_timeout': float(
+            user_arguments.connect_timeout or os.getenv('CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)
+        ),
+        'backoff_base': float(user_arguments.backoff_base or os.getenv('BACKOFF_BASE', DEFAULT_BACKOFF_BASE)),
+        'backoff_max': float(user_arguments.backoff_max or os.getenv('BACKOFF_MAX', DEFAULT_BACKOFF_MAX)),
+        'max_line_length': int(
+            user_arguments.max_line_length or os.getenv('MAX_LINE_LENGTH', DEFAULT_MAX_LINE_LENGTH)
+        ),
+        'oversize_policy': oversize_policy,
+        'ack_timeout': float(user_arguments.ack_timeout or os.getenv('ACK_TIMEOUT', DEFAULT_ACK_TIMEOUT)),
+        'watchdog_timeout': float(user_arguments.watchdog_timeout or os.getenv('WATCHDOG_TIMEOUT', 5)),
+        'send_max_batch': int(user_arguments.send_batch or os.getenv('SEND_MAX_BATCH', DEFAULT_SEND_BATCH)),
+    }
+
+
+def create_message_processor(user_arguments):
+    """Return message processor, None without rules, and display rules for messages read from history."""
+    processing_pool = user_arguments.processing_pool or os.getenv('PROCESSING_POOL', 'thread')
+    if processing_pool not in PROCESSING_POOLS:
+        logging.error(f'unknown processing pool {processing_pool}')
+        sys.exit(2)
+    processing_workers = int(
+        user_arguments.processing_workers or os.getenv('PROCESSING_WORKERS', DEFAULT_PROCESSING_WORKERS)
+    )
+    try:
+        message_rules, display_rules = load_rules(
+            user_arguments.message_rules or os.getenv('MESSAGE_RULES'),
+            user_arguments.highlight or os.getenv('HIGHLIGHT_PATTERN'),
+            user_arguments.mask_words or os.getenv('MASK_WORDS'),
+            user_arguments.mask_history or os.getenv('MASK_HISTORY') == '1'
+        )
+    except RulesConfigError as error:
+        logging.error(error)
+        sys.exit(2)
+    # process workers are started by forkserver or spawn, threads of this process are not copied to them,
+    # without rules messages are not passed to workers at all
+    message_processor = None
+    if message_rules or display_rules:
+        message_processor = MessageProcessor(message_rules, display_rules, processing_pool, processing_workers)
+    return message_processor, display_rules
+
+
+class Monitoring:
+    """Metrics log, metrics endpoint and profiling of one client run."""
+
+    def __init__(self, user_arguments):
+        self.metrics_interval = user_arguments.metrics_interval
+        if self.metrics_interval is None:
+            self.metrics_interval = float(os.getenv('METRICS_LOG_INTERVAL', 0))
+        self.metrics_port = user_arguments.metrics_port
+        if self.metrics_port is None:
+            self.metrics_port = int(os.getenv('METRICS_PORT', 0))
+        self.profile = user_arguments.profile or os.getenv('PROFILE') == '1'
+        self.profile_dir_path = os.getenv('PROFILE_DIR_PATH', './profile')
+
+    def profile_run(self, name):
+        if not self.profile:
+            return contextlib.nullcontext()
+        from core.profiling import profile_run
+        return profile_run(self.profile_dir_path, name)
+
+    def start(self, nursery):
+        if self.metrics_interval:
+            nursery.start_soon(log_metrics(self.metrics_interval))
+        if self.metrics_port:
+            nursery.start_soon(serve_metrics(self.metrics_port))
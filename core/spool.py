@@ -0,0 +1,208 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict, deque
+
+from aiofile import AIOFile
+
+from core.metrics import metrics
+
+SPOOL_FILE_NAME = 'outbound.spool'
+DEFAULT_SPOOL_SIZE = 1000
+DEFAULT_ACK_TIMEOUT = 10
+
+
+def collect_spools_depth():
+    metrics.set('spool_depth', sum(len(spool) for spool in OutboundSpool.spools))
+
+
+def read_spool_entries(spool_path):
+    """Return [(entry_id, text)] not acknowledged yet, in sending order."""
+    entries = OrderedDict()
+    if not os.path.exists(spool_path):
+        return []
+    with open(spool_path, encoding='utf-8') as spool_file:
+        for line in spool_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # last record may be cut by crash during write
+                logging.warning(f'broken outbound spool record is skipped: {line!r}')
+                continue
+            if 'ack' in record:
+                entries.pop(record['ack'], None)
+            else:
+                entries[record['id']] = record['text']
+    return list(entries.items())
+
+
+def write_spool_entries(spool_path, entries):
+    tmp_path = f'{spool_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as spool_file:
+        for entry_id, text in entries:
+            spool_file.write(json.dumps({'id': entry_id, 'text': text}, ensure_ascii=False) + '\n')
+        spool_file.flush()
+        os.fsync(spool_file.fileno())
+    os.replace(tmp_path, spool_path)
+
+
+class OutboundSpool:
+    """Messages to send, kept on disk until the chat shows them back.
+
+    put_nowait is queue-like, so window and bots use spool as sending queue.
+    Entry is given to sender only after it is saved, and removed only after
+    it was drained to socket and its echo came on read connection.
+    spool_path None keeps entries in memory only.
+    """
+
+    spools = weakref.WeakSet()
+
+    def __init__(self, spool_path=None, maxsize=DEFAULT_SPOOL_SIZE):
+        self.spool_path = spool_path
+        self.maxsize = maxsize
+        self.nickname = None
+        self.next_id = 0
+        self.unsaved = []
+        self.pending = deque()
+        self.in_flight = OrderedDict()
+        self.acknowledged = []
+        self.read_seen_at = 0
+        self.spool_file = None
+        self.offset = 0
+        self.changed = asyncio.Event()
+        self.saved = asyncio.Event()
+        OutboundSpool.spools.add(self)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def __len__(self):
+        return len(self.unsaved) + len(self.pending) + len(self.in_flight)
+
+    async def open(self):
+        if not self.spool_path:
+            return
+        loop = asyncio.get_event_loop()
+        entries = await loop.run_in_executor(None, read_spool_entries, self.spool_path)
+        # acknowledged records are dropped on start, file holds only what is still to send
+        await loop.run_in_executor(None, write_spool_entries, self.spool_path, entries)
+        # monotonic time of previous run is lost, send latency of loaded entries counts from start
+        loaded_at = time.monotonic()
+        self.pending.extend((entry_id, text, loaded_at) for entry_id, text in entries)
+        if entries:
+            self.next_id = entries[-1][0] + 1
+            logging.info(f'{len(entries)} unsent messages are loaded from outbound spool')
+            self.saved.set()
+        self.spool_file = AIOFile(self.spool_path, 'a')
+        await self.spool_file.open()
+        self.offset = os.path.getsize(self.spool_path)
+
+    async def close(self):
+        if self.spool_file:
+            await self._save()
+            await self.spool_file.close()
+
+    def put_nowait(self, text):
+        # the same cleaning as before sending, so echo is compared with what chat really got
+        text = text.replace('\n', '').strip()
+        if not text:
+            return
+        if len(self) >= self.maxsize:
+            metrics.inc('spool_rejected')
+            raise asyncio.QueueFull()
+        self.unsaved.append((self.next_id, text, time.monotonic()))
+        self.next_id += 1
+        self.changed.set()
+
+    async def put(self, text):
+        self.put_nowait(text)
+
+    async def save_entries(self):
+        """Write new entries and acknowledgements to disk, only then entries are sent."""
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            await self._save()
+
+    async def _save(self):
+        entries, self.unsaved = self.unsaved, []
+        acknowledged, self.acknowledged = self.acknowledged, []
+        if self.spool_file and (entries or acknowledged):
+            records = [{'id': entry_id, 'text': text} for entry_id, text, _ in entries]
+            records.extend({'ack': entry_id} for entry_id in acknowledged)
+            data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            await self.spool_file.write(data, offset=self.offset)
+            self.offset += len(data.encode())
+            if entries:
+                await self.spool_file.fsync()
+            if not entries and not len(self):
+                # everything is delivered, file starts from scratch
+                await self.spool_file.close()
+                self.spool_file = AIOFile(self.spool_path, 'w')
+                await self.spool_file.open()
+                self.offset = 0
+        self.pending.extend(entries)
+        if self.pending:
+            self.saved.set()
+
+    async def get_batch(self, max_batch):
+        while not self.pending:
+            self.saved.clear()
+            await self.saved.wait()
+        batch = []
+        while self.pending and len(batch) < max_batch:
+            batch.append(self.pending.popleft())
+        return batch
+
+    def mark_sent(self, entries):
+        sent_at = time.monotonic()
+        for entry_id, text, enqueued_at in entries:
+            self.in_flight[entry_id] = (text, enqueued_at, sent_at)
+
+    def requeue_in_flight(self):
+        """Put not confirmed entries back to the head, they are sent again in the same order."""
+        if not self.in_flight:
+            return
+        metrics.inc('spool_retries', len(self.in_flight))
+        entries = [(entry_id, text, enqueued_at) for entry_id, (text, enqueued_at, _) in self.in_flight.items()]
+        self.in_flight.clear()
+        self.pending.extendleft(reversed(entries))
+        self.saved.set()
+
+    def confirm_echo(self, line):
+        if not self.in_flight:
+            return
+        self.read_seen_at = time.monotonic()
+        for entry_id, (text, _, sent_at) in self.in_flight.items():
+            if line == f'{self.nickname}: {text}':
+                del self.in_flight[entry_id]
+                metrics.observe('echo_latency_seconds', self.read_seen_at - sent_at)
+                self.acknowledged.append(entry_id)
+                self.changed.set()
+                metrics.inc('spool_acked')
+                return
+
+    def is_echo_overdue(self, ack_timeout):
+        # without lines on read connection after sending, echo may be just delayed by reader reconnect
+        if not self.in_flight:
+            return False
+        *_, oldest_sent_at = next(iter(self.in_flight.values()))
+        return time.monotonic() - oldest_sent_at > ack_timeout and self.read_seen_at > oldest_sent_at
+
+
+metrics.add_collector(collect_spools_depth)
+
+
+async def watch_for_echo(spool, ack_timeout=DEFAULT_ACK_TIMEOUT, check_interval=1):
+    while True:
+        await asyncio.sleep(check_interval)
+        if spool.is_echo_overdue(ack_timeout):
+            metrics.inc('spool_echo_timeouts')
+            raise ConnectionError(f'sent messages are not shown in chat for {ack_timeout}s')
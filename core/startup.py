@@ -0,0 +1,24 @@
+import logging
+import time
+
+from core.metrics import metrics
+
+
+class StartupTrace:
+    """Seconds from process start to startup steps, every step is logged once."""
+
+    def __init__(self, started_at):
+        # wall time, so it can be compared with receive time of messages
+        self.started_at = started_at
+        self.steps = {}
+
+    def mark(self, step):
+        if step in self.steps:
+            return
+        elapsed = time.time() - self.started_at
+        self.steps[step] = elapsed
+        metrics.set(f'startup_{step}_seconds', round(elapsed, 3))
+        logging.info(f'startup: {step} after {elapsed:.3f}s')
+
+    def is_received_after_start(self, message):
+        return bool(message.timestamp) and message.timestamp >= self.started_at
@@ -0,0 +1,38 @@
+import asyncio
+import logging
+import time
+
+
+class ConnectionLiveness:
+    def __init__(self, connection_names):
+        now = time.monotonic()
+        self.last_seen = dict.fromkeys(connection_names, now)
+        self.seen = dict.fromkeys(connection_names, False)
+
+    def touch(self, connection_name):
+        # hot path: only a flag, time is taken once per check by watchdog timer
+        self.seen[connection_name] = True
+
+    def refresh(self, now, connection_names=None):
+        for connection_name, seen in self.seen.items():
+            if seen:
+                self.last_seen[connection_name] = now
+                self.seen[connection_name] = False
+        return now - max(self.last_seen[connection_name] for connection_name in connection_names or self.last_seen)
+
+
+async def watch_for_connection(liveness, timeout=5, check_interval=1, debug=False, connection_names=None):
+    logger = logging.getLogger('watchdog_logger')
+    while True:
+        await asyncio.sleep(check_interval)
+        now = time.monotonic()
+        # connections are alive while any of them shows activity, quiet chat is not a failure
+        silence = liveness.refresh(now, connection_names)
+        if debug:
+            logger.debug(', '.join(
+                f'{connection_name} seen {now - last_seen:.1f}s ago'
+                for connection_name, last_seen in liveness.last_seen.items()
+            ))
+        if silence > timeout:
+            logger.info(f'{timeout}s timeout is elapsed')
+            raise ConnectionError
@@ -1,160 +1,138 @@
+import time
+
+# taken before other imports, so startup trace counts them too
+STARTED_AT = time.time()
+
 import argparse
 import asyncio
 import contextlib
-import logging.config
+import logging
 import os
-import socket
 import sys
-from datetime import datetime
-from tkinter import messagebox
-
-import aionursery
-from aiofile import AIOFile
-from async_timeout import timeout
 
 from core import gui
-from core.chat_reader import read_stream_chat, save_messages
-from core.chat_tool import (
-    ReadConnectionStateChanged,
-    SendingConnectionStateChanged,
-    register,
-    send_watchdog_messages,
-    NicknameReceived,
-    get_open_connection_tools
+from core.chat_reader import DEFAULT_REPLAY_WINDOW
+from core.chat_writer import InvalidToken
+from core.logs import setup_logging
+from core.processing import apply_display_rules
+from core.pipeline import QueuesConfigError, create_queues, parse_queues_config
+from core.rooms import Room, RoomsConfigError, parse_rooms_config
+from core.spool import SPOOL_FILE_NAME, OutboundSpool
+from core.session import create_handy_nursery, handle_connection
+from core.settings import (
+    Monitoring,
+    add_common_arguments,
+    create_message_processor,
+    read_connection_settings,
+    read_log_settings,
+    read_server_settings
+)
+from core.history import (
+    COMPRESSION_SUFFIXES,
+    DEFAULT_FSYNC_BYTES,
+    DEFAULT_FSYNC_INTERVAL,
+    DEFAULT_SEGMENT_SIZE,
+    DEFAULT_WRITE_BATCH,
+    DEFAULT_WRITE_LATENCY,
+    HistoryLog,
+    HistoryPager,
+    is_zstandard_installed,
+    migrate_legacy_history
 )
-from core.chat_writer import InvalidToken, authorise, write_stream_chat
+from core.startup import StartupTrace
 
 
-@contextlib.asynccontextmanager
-async def create_handy_nursery():
+async def handle_gui_connection(*args, **kwargs):
     try:
-        async with aionursery.Nursery() as nursery:
-            yield nursery
-    except aionursery.MultiError as e:
-        if len(e.exceptions) == 1:
-            raise e.exceptions[0]
+        await handle_connection(*args, **kwargs)
+    except InvalidToken:
+        from tkinter import messagebox
+        messagebox.showinfo("Неверный токен", "Проверьте токен, сервер не узнал его")
         raise
 
 
-async def read_connection(
-        reader, messages_queue, history_queue, watchdog_queue, history_log_path
-):
-    async with contextlib.AsyncExitStack() as stack:
-        nursery = await stack.enter_async_context(create_handy_nursery())
-        nursery.start_soon(
-            read_stream_chat(reader, messages_queue, history_queue, watchdog_queue))
-        nursery.start_soon(
-            save_messages(history_log_path, history_queue)
-        )
-
-
-async def send_connection(writer, reader, watchdog_queue, sending_queue):
-    async with create_handy_nursery() as nursery:
-        nursery.start_soon(
-            write_stream_chat(writer, sending_queue, watchdog_queue)
-        )
-        nursery.start_soon(
-            send_watchdog_messages(writer, reader, watchdog_queue)
-        )
-
-
-async def watch_for_connection(watchdog_queue):
-    logger = logging.getLogger('watchdog_logger')
-    while True:
-        current_timestamp = datetime.now().timestamp()
-        try:
-            async with timeout(5):
-                message = await watchdog_queue.get()
-                logger.info(f'[{current_timestamp}] {message}')
-            # because context manager doesn't work
-        except asyncio.TimeoutError:
-            logger.info(f'[{current_timestamp}] 5s timeout is elapsed')
-            raise ConnectionError
-
-
-async def handle_connection(host, read_port, send_port, messages_queue, history_queue, watchdog_queue, sending_queue,
-                            status_updates_queue, token, attempts,
-                            history_log_path):
-    while True:
-        async with contextlib.AsyncExitStack() as stack:
-
-            status_updates_queue.put_nowait(SendingConnectionStateChanged.INITIATED)
-            status_updates_queue.put_nowait(ReadConnectionStateChanged.INITIATED)
-
-            (reader, _) = await stack.enter_async_context(get_open_connection_tools(
-                host, read_port, attempts)
-            )
-            (write_reader, write_writer) = await stack.enter_async_context(get_open_connection_tools(
-                host, send_port, attempts)
-            )
-
-            status_updates_queue.put_nowait(SendingConnectionStateChanged.ESTABLISHED)
-            status_updates_queue.put_nowait(ReadConnectionStateChanged.ESTABLISHED)
-            try:
-                if token:
-                    nickname = await authorise(write_reader, write_writer, token, watchdog_queue)
-                    msg = f'Выполнена авторизация. Пользователь {nickname}.'
-                    logging.debug(msg)
-                else:
-                    user_data = await register(write_reader, write_writer)
-                    nickname = user_data.get('nickname')
-                status_updates_queue.put_nowait(NicknameReceived(nickname))
-                async with create_handy_nursery() as nursery:
-                    nursery.start_soon(
-                        read_connection(reader, messages_queue, history_queue, watchdog_queue, history_log_path)
-                    )
-                    nursery.start_soon(
-                        send_connection(write_writer, write_reader, watchdog_queue, sending_queue)
-                    )
-                    nursery.start_soon(
-                        watch_for_connection(watchdog_queue)
-                    )
-            except (
-                    socket.gaierror,
-                    ConnectionRefusedError,
-                    ConnectionResetError,
-                    ConnectionError,
-            ):
-                status_updates_queue.put_nowait(SendingConnectionStateChanged.CLOSED)
-                status_updates_queue.put_nowait(ReadConnectionStateChanged.CLOSED)
-                continue
-            except InvalidToken:
-                messagebox.showinfo("Неверный токен", "Проверьте токен, сервер не узнал его")
-                raise
-            break
-
-
-def setup_loggers():
-    main_logger = logging.getLogger('')
-    main_logger.setLevel(logging.DEBUG)
+def setup_loggers(log_level, log_sample_rate, watchdog_debug=False):
+    setup_logging(log_level, log_sample_rate)
 
     watchdog_logger = logging.getLogger('watchdog_logger')
-    watchdog_logger.setLevel(logging.INFO)
+    watchdog_logger.setLevel(logging.DEBUG if watchdog_debug else logging.INFO)
+
+    metrics_logger = logging.getLogger('metrics_logger')
+    metrics_logger.setLevel(logging.INFO)
 
 
 def create_parser_for_user_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--host', required=False,
-                        help='chat host',
+    add_common_arguments(parser)
+    parser.add_argument('--rooms', required=False,
+                        help='several chats in tabs of one window, e.g. main=minechat.dvmn.org:5000:5050,'
+                             'test=localhost:5000:5050:token, history of every room is kept in its folder',
                         type=str)
-    parser.add_argument('--read_port', required=False,
-                        help='chat port for reading messages',
-                        type=int)
-    parser.add_argument('--send_port', required=False,
-                        help='chat port for sending messages',
-                        type=int)
     parser.add_argument('--history', required=False,
                         help='history log dir path',
                         type=str)
-    parser.add_argument('--attempts', required=False,
-                        help='connect attempts before timeout',
-                        type=str)
     parser.add_argument('--token', required=False,
                         help='user token',
                         type=str)
     parser.add_argument('--token_file_path', required=False,
                         help='file with token path',
                         type=str)
+    parser.add_argument('--render_batch', required=False,
+                        help='max messages rendered per frame',
+                        type=int)
+    parser.add_argument('--render_latency', required=False,
+                        help='max seconds a message waits before render',
+                        type=float)
+    parser.add_argument('--scrollback', required=False,
+                        help='max messages kept in memory for chat window, older are read from history log, '
+                             '0 - unlimited',
+                        type=int)
+    parser.add_argument('--history_segment_size', required=False,
+                        help='history log segment size in bytes before rotation, 0 - unlimited',
+                        type=int)
+    parser.add_argument('--history_rotate_daily', required=False,
+                        help='start new history log segment every day',
+                        action='store_true')
+    parser.add_argument('--history_compression', required=False,
+                        help='compression of closed history log segments',
+                        choices=list(COMPRESSION_SUFFIXES))
+    parser.add_argument('--history_batch', required=False,
+                        help='max messages written to history log at once',
+                        type=int)
+    parser.add_argument('--history_latency', required=False,
+                        help='max seconds a message waits before written to history log',
+                        type=float)
+    parser.add_argument('--fsync_bytes', required=False,
+                        help='fsync history log after this many bytes, 0 - disabled',
+                        type=int)
+    parser.add_argument('--fsync_interval', required=False,
+                        help='fsync history log after this many seconds, 0 - disabled',
+                        type=float)
+    parser.add_argument('--no_search_index', required=False,
+                        help='do not build full-text search index of history',
+                        action='store_true')
+    parser.add_argument('--queues', required=False,
+                        help='queues size and overflow policy, e.g. messages=10000:drop_oldest,history=100000:block',
+                        type=str)
+    parser.add_argument('--watchdog_debug', required=False,
+                        help='log connection activity on every watchdog check',
+                        action='store_true')
+    parser.add_argument('--gui_mode', required=False,
+                        help='poll - redraw window 120 times per second, adaptive - only when there are events, '
+                             'thread - window in its own thread',
+                        choices=gui.GUI_MODES)
+    parser.add_argument('--history_lines', required=False,
+                        help='history lines loaded on start',
+                        type=int)
+    parser.add_argument('--view_margin', required=False,
+                        help='lines kept in chat window above and below visible ones',
+                        type=int)
+    parser.add_argument('--startup_trace', required=False,
+                        help='log seconds from start to imports, window, loaded history and first message',
+                        action='store_true')
+    parser.add_argument('--register', required=False,
+                        help='register new user first, chat goes on with the connection used for registration',
+                        action='store_true')
     namespace = parser.parse_args()
     return namespace
 
@@ -164,14 +142,67 @@ async def get_token_from_file(token_file_path=None):
         token_file_path = './token.txt'
         if not os.path.exists(token_file_path):
             return
+    from aiofile import AIOFile
     async with AIOFile(token_file_path) as token_file:
         token = await token_file.read()
         return token
 
 
+async def load_history_tail(history_pager, history_lines, messages_queue, startup_trace=None,
+                            replay_window=DEFAULT_REPLAY_WINDOW):
+    """Put last history lines to chat window, return stored lines for replay filter."""
+    # one read for window and replay filter, filter compares stored text, window shows it after display rules
+    history = await HistoryPager(history_pager.history_log_path).read_tail(max(history_lines, replay_window))
+    shown_history = history[-history_lines:] if history_lines else []
+    for message in apply_display_rules(history_pager.display_rules, shown_history):
+        messages_queue.put_nowait(message)
+    if startup_trace:
+        startup_trace.mark('history')
+    return [message.to_line() for message in history]
+
+
+async def open_room(room, queues_config, sending_spool_size, use_search_index, display_rules=(),
+                    **history_settings):
+    # every room has its own queues, history log, search index and outbound spool in its folder
+    queues = create_queues(queues_config, f'{room.name}_' if room.name else '')
+    room.messages_queue = queues['messages']
+    room.status_updates_queue = queues['status']
+    room.history_queue = queues['history']
+    await asyncio.get_event_loop().run_in_executor(None, migrate_legacy_history, room.history_log_path)
+    if use_search_index:
+        from core.search import SearchIndex, SearchIndexUnavailable
+        room.search_index = SearchIndex(room.history_log_path)
+        try:
+            await room.search_index.open()
+        except SearchIndexUnavailable as error:
+            logging.error(f'search index is disabled: {error}')
+            room.search_index = None
+    room.history_log = HistoryLog(room.history_log_path, search_index=room.search_index, **history_settings)
+    room.history_pager = HistoryPager(room.history_log_path, display_rules)
+    room.sending_spool = OutboundSpool(os.path.join(room.history_log_path, SPOOL_FILE_NAME), sending_spool_size)
+
+
+async def connect_when_ready(room, token, token_file_path, history_lines, startup_trace=None, **connection_settings):
+    # window is already shown, connections are opened while history tail is loaded
+    token = room.token or token
+    if not token:
+        token = await get_token_from_file(token_file_path)
+    history_loading = asyncio.ensure_future(
+        load_history_tail(room.history_pager, history_lines, room.messages_queue, startup_trace)
+    )
+    try:
+        await handle_gui_connection(
+            room.host, room.read_port, room.send_port, room.messages_queue, room.history_queue, room.sending_spool,
+            room.status_updates_queue, token, history_log=room.history_log, recent_lines=history_loading,
+            **connection_settings
+        )
+    finally:
+        history_loading.cancel()
+
 async def main():
-    setup_loggers()
     user_arguments = create_parser_for_user_arguments()
+    watchdog_debug = user_arguments.watchdog_debug or os.getenv('WATCHDOG_DEBUG') == '1'
+    setup_loggers(*read_log_settings(user_arguments), watchdog_debug)
     history_log_path = user_arguments.history or os.getenv('HISTORY_LOG_DIR_PATH', f'{os.getcwd()}')
 
     if not os.path.exists(history_log_path):
@@ -179,38 +210,112 @@ async def main():
         sys.exit(2)
 
     token_file_path = user_arguments.token_file_path or os.getenv('TOKEN_FILE_PATH')
-    if user_arguments.token_file_path and not os.path.exists(user_arguments.token_file_path):
+    register = user_arguments.register or os.getenv('REGISTER') == '1'
+    # token file is written by registration
+    if user_arguments.token_file_path and not os.path.exists(user_arguments.token_file_path) and not register:
         logging.error(f'token file path does not exist {user_arguments.token_file_path}')
         sys.exit(2)
     elif user_arguments.token_file_path:
         token_file_path = user_arguments.token_file_path
 
-    token_from_file = await get_token_from_file(token_file_path)
-    host = user_arguments.host or os.getenv('HOST', 'minechat.dvmn.org')
-    read_port = user_arguments.read_port or os.getenv('READ_PORT', 5000)
-    send_port = user_arguments.send_port or os.getenv('SEND_PORT', 5050)
-    attempts = int(user_arguments.attempts or os.getenv('ATTEMPTS_COUNT', 3))
-    token = user_arguments.token or os.getenv('TOKEN') or token_from_file
-    messages_queue = asyncio.Queue()
-    sending_queue = asyncio.Queue()
-    status_updates_queue = asyncio.Queue()
-    history_queue = asyncio.Queue()
-    watchdog_queue = asyncio.Queue()
-    if os.path.exists(f'{history_log_path}/history_logs.txt'):
-        with open(f'{history_log_path}/history_logs.txt') as log_file:
-            messages_queue.put_nowait(log_file.read())
-
-    async with create_handy_nursery() as nursery:
-        nursery.start_soon(
-            gui.draw(messages_queue, sending_queue, status_updates_queue)
+    host, read_port, send_port = read_server_settings(user_arguments)
+    try:
+        rooms = parse_rooms_config(user_arguments.rooms or os.getenv('ROOMS'), history_log_path)
+    except RoomsConfigError as error:
+        logging.error(error)
+        sys.exit(2)
+    if register and len(rooms) > 1:
+        logging.error('registration is done for one chat, rooms are not supported with it')
+        sys.exit(2)
+    # without rooms the only chat keeps history right in history folder
+    rooms = rooms or [Room('', host, read_port, send_port, history_log_path=history_log_path)]
+    for room in rooms:
+        os.makedirs(room.history_log_path, exist_ok=True)
+    connection_settings = read_connection_settings(user_arguments)
+    token = user_arguments.token or os.getenv('TOKEN')
+    render_max_batch = int(user_arguments.render_batch or os.getenv('RENDER_MAX_BATCH', 1000))
+    render_max_latency = float(user_arguments.render_latency or os.getenv('RENDER_MAX_LATENCY', 1 / 30))
+    scrollback_lines = user_arguments.scrollback
+    if scrollback_lines is None:
+        scrollback_lines = int(os.getenv('SCROLLBACK_LINES', 10000))
+    history_segment_size = user_arguments.history_segment_size
+    if history_segment_size is None:
+        history_segment_size = int(os.getenv('HISTORY_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE))
+    history_rotate_daily = user_arguments.history_rotate_daily or os.getenv('HISTORY_ROTATE_DAILY') == '1'
+    history_compression = user_arguments.history_compression or os.getenv('HISTORY_COMPRESSION') or None
+    if history_compression and history_compression not in COMPRESSION_SUFFIXES:
+        logging.error(f'unknown history compression {history_compression}')
+        sys.exit(2)
+    if history_compression == 'zstd' and not is_zstandard_installed():
+        logging.error('zstd history compression requires zstandard package')
+        sys.exit(2)
+    history_write_batch = int(user_arguments.history_batch or os.getenv('HISTORY_WRITE_BATCH', DEFAULT_WRITE_BATCH))
+    history_write_latency = user_arguments.history_latency
+    if history_write_latency is None:
+        history_write_latency = float(os.getenv('HISTORY_WRITE_LATENCY', DEFAULT_WRITE_LATENCY))
+    fsync_bytes = user_arguments.fsync_bytes
+    if fsync_bytes is None:
+        fsync_bytes = int(os.getenv('HISTORY_FSYNC_BYTES', DEFAULT_FSYNC_BYTES))
+    fsync_interval = user_arguments.fsync_interval
+    if fsync_interval is None:
+        fsync_interval = float(os.getenv('HISTORY_FSYNC_INTERVAL', DEFAULT_FSYNC_INTERVAL))
+    monitoring = Monitoring(user_arguments)
+    message_processor, display_rules = create_message_processor(user_arguments)
+    startup_trace = None
+    if user_arguments.startup_trace or os.getenv('STARTUP_TRACE') == '1':
+        startup_trace = StartupTrace(STARTED_AT)
+        startup_trace.mark('imports')
+    gui_mode = user_arguments.gui_mode or os.getenv('GUI_MODE', 'adaptive')
+    if gui_mode not in gui.GUI_MODES:
+        logging.error(f'unknown gui mode {gui_mode}')
+        sys.exit(2)
+    gui_max_interval = float(os.getenv('GUI_MAX_INTERVAL', 1 / 20))
+    history_lines = int(user_arguments.history_lines or os.getenv('HISTORY_PAGE_LINES', 200))
+    view_margin = int(user_arguments.view_margin or os.getenv('VIEW_MARGIN_LINES', gui.DEFAULT_VIEW_MARGIN))
+    try:
+        queues_config = parse_queues_config(user_arguments.queues or os.getenv('QUEUES'))
+    except QueuesConfigError as error:
+        logging.error(error)
+        sys.exit(2)
+    # sending messages are kept in outbound spool, its size is taken from sending queue settings
+    sending_spool_size, _ = queues_config.pop('sending')
+    use_search_index = not user_arguments.no_search_index and os.getenv('SEARCH_INDEX', '1') == '1'
+    for room in rooms:
+        await open_room(
+            room, queues_config, sending_spool_size, use_search_index, display_rules,
+            segment_size=history_segment_size, rotate_daily=history_rotate_daily, compression=history_compression,
+            write_batch=history_write_batch, write_latency=history_write_latency,
+            fsync_bytes=fsync_bytes, fsync_interval=fsync_interval
         )
 
-        nursery.start_soon(
-            handle_connection(host, read_port, send_port, messages_queue, history_queue,
-                              watchdog_queue, sending_queue,
-                              status_updates_queue,
-                              token, attempts, history_log_path)
+    credentials = registered_connection = None
+    if register:
+        from chat_register import register_user
+        credentials, registered_connection = await register_user(
+            rooms[0].host, rooms[0].send_port, connection_settings['attempts'], token_file_path or './token.txt',
+            keep_connection=True
         )
+        token = credentials.token
+
+    with monitoring.profile_run('gui_chat'), message_processor or contextlib.nullcontext():
+        async with contextlib.AsyncExitStack() as stack:
+            for room in rooms:
+                await stack.enter_async_context(room.sending_spool)
+            # one event loop keeps connections of all rooms, one window shows them in tabs
+            nursery = await stack.enter_async_context(create_handy_nursery())
+            nursery.start_soon(
+                gui.draw(rooms, render_max_batch, render_max_latency, scrollback_lines, view_margin,
+                         gui_mode, gui_max_interval, startup_trace)
+            )
+
+            for room in rooms:
+                nursery.start_soon(
+                    connect_when_ready(room, token, token_file_path, history_lines, startup_trace,
+                                       watchdog_debug=watchdog_debug, credentials=credentials,
+                                       registered_connection=registered_connection,
+                                       message_processor=message_processor, **connection_settings)
+                )
+            monitoring.start(nursery)
 
 
 if __name__ == '__main__':
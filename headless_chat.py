@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+
+from core.chat_tool import ConnectionRateLimiter
+from core.headless import HeadlessSession, SessionsFileError, load_sink, read_sessions_file, run_session
+from core.history import HistoryLog
+from core.logs import setup_logging
+from core.session import create_handy_nursery
+from core.settings import (
+    Monitoring,
+    add_common_arguments,
+    create_message_processor,
+    read_connection_settings,
+    read_log_settings,
+    read_server_settings
+)
+
+
+def setup_loggers(log_level, log_sample_rate):
+    setup_logging(log_level, log_sample_rate)
+
+    metrics_logger = logging.getLogger('metrics_logger')
+    metrics_logger.setLevel(logging.INFO)
+
+
+def create_parser_for_user_arguments():
+    parser = argparse.ArgumentParser()
+    add_common_arguments(parser)
+    parser.add_argument('--sessions_file_path', required=False,
+                        help='file with "token" or "name token" line for every session',
+                        type=str)
+    parser.add_argument('--sink', required=False,
+                        help='where received messages go: print, null or package.module:coroutine',
+                        type=str)
+    parser.add_argument('--history', required=False,
+                        help='dir for history log of every session, not kept if not set',
+                        type=str)
+    parser.add_argument('--connect_rate', required=False,
+                        help='max connection setups per second for all sessions',
+                        type=float)
+    parser.add_argument('--connect_burst', required=False,
+                        help='connection setups allowed at once before rate limit',
+                        type=int)
+    namespace = parser.parse_args()
+    return namespace
+
+
+async def main():
+    user_arguments = create_parser_for_user_arguments()
+    setup_loggers(*read_log_settings(user_arguments))
+    host, read_port, send_port = read_server_settings(user_arguments)
+    connection_settings = read_connection_settings(user_arguments)
+    sessions_file_path = user_arguments.sessions_file_path or os.getenv('SESSIONS_FILE_PATH', './sessions.txt')
+    if not os.path.exists(sessions_file_path):
+        logging.error(f'sessions file path does not exist {sessions_file_path}')
+        sys.exit(2)
+    try:
+        sink = load_sink(user_arguments.sink or os.getenv('HEADLESS_SINK', 'print'))
+    except (ValueError, ImportError, AttributeError) as error:
+        logging.error(f'sink is not loaded: {error!r}')
+        sys.exit(2)
+    history_log_path = user_arguments.history or os.getenv('HEADLESS_HISTORY_DIR_PATH')
+    if history_log_path and not os.path.exists(history_log_path):
+        logging.error(f'history log path does not exist {history_log_path}')
+        sys.exit(2)
+    connect_rate = float(user_arguments.connect_rate or os.getenv('CONNECT_RATE', 10))
+    connect_burst = int(user_arguments.connect_burst or os.getenv('CONNECT_BURST', 10))
+    monitoring = Monitoring(user_arguments)
+    message_processor, _ = create_message_processor(user_arguments)
+
+    try:
+        sessions_settings = await read_sessions_file(sessions_file_path)
+    except SessionsFileError as error:
+        logging.error(error)
+        sys.exit(2)
+    sessions = []
+    for name, token in sessions_settings:
+        history_log = None
+        if history_log_path:
+            session_history_log_path = os.path.join(history_log_path, name)
+            os.makedirs(session_history_log_path, exist_ok=True)
+            history_log = HistoryLog(session_history_log_path)
+        sessions.append(HeadlessSession(name, token, sink, history_log))
+    logging.info(f'starting {len(sessions)} sessions')
+
+    # all sessions wait for one bucket, so reconnect after server restart is spread in time
+    rate_limiter = ConnectionRateLimiter(connect_rate, connect_burst)
+    with monitoring.profile_run('headless_chat'), message_processor or contextlib.nullcontext():
+        async with create_handy_nursery() as nursery:
+            for session in sessions:
+                nursery.start_soon(
+                    run_session(session, host, read_port, send_port, rate_limiter=rate_limiter,
+                                message_processor=message_processor, **connection_settings)
+                )
+            monitoring.start(nursery)
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        exit()
@@ -0,0 +1,61 @@
+import asyncio
+
+from core.chat_reader import ReplayFilter, read_stream_chat
+from core.spool import OutboundSpool
+
+
+class Liveness:
+    def touch(self, name):
+        pass
+
+
+async def read_chunks(chunks, replay_filter, spool):
+    reader = asyncio.StreamReader()
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+    messages_queue = asyncio.Queue()
+    try:
+        await read_stream_chat(reader, messages_queue, None, Liveness(), replay_filter, spool)
+    except ConnectionResetError:
+        pass
+
+
+async def send_entry(spool, text):
+    spool.nickname = 'neo'
+    spool.put_nowait(text)
+    await spool._save()
+    spool.mark_sent(await spool.get_batch(1))
+
+
+def test_replayed_line_does_not_confirm_new_message():
+    async def check():
+        spool = OutboundSpool()
+        replay_filter = ReplayFilter(['neo: hi', 'b: +'])
+        replay_filter.resume()
+        await send_entry(spool, 'hi')
+        await read_chunks([b'neo: hi\nb: +\n'], replay_filter, spool)
+        assert len(spool.in_flight) == 1
+        await read_chunks([b'neo: hi\n'], replay_filter, spool)
+        assert not spool.in_flight
+
+    asyncio.run(check())
+
+
+def test_held_live_line_is_shown_and_confirms_echo_in_quiet_chat():
+    async def check():
+        spool = OutboundSpool()
+        replay_filter = ReplayFilter(['neo: hi', 'b: +'], hold_time=0.05)
+        replay_filter.resume()
+        await send_entry(spool, 'hi')
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'neo: hi\n')
+        messages_queue = asyncio.Queue()
+        reading = asyncio.ensure_future(
+            read_stream_chat(reader, messages_queue, None, Liveness(), replay_filter, spool)
+        )
+        message = await asyncio.wait_for(messages_queue.get(), 1)
+        reading.cancel()
+        assert message.to_line() == 'neo: hi' and not spool.in_flight
+
+    asyncio.run(check())
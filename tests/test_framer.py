@@ -0,0 +1,23 @@
+from core.chat_tool import LineFramer
+
+
+def feed_chunks(framer, chunks):
+    return [line for chunk in chunks for line in framer.feed(chunk)]
+
+
+def test_lines_split_between_chunks_are_joined():
+    framer = LineFramer()
+    chunks = [b'a: he', b'llo\r\nb: ', b'\xd0\xbf', b'\xd1\x80\xd0\xb8\n', b'c']
+    assert feed_chunks(framer, chunks) == ['a: hello', 'b: при']
+    assert framer.feed(b': bye\n') == ['c: bye']
+
+
+def test_oversize_line_is_truncated_and_its_tail_is_not_kept():
+    framer = LineFramer(max_line_length=5)
+    assert feed_chunks(framer, [b'0123', b'456789', b'abcdef', b'gh\nok\n']) == ['01234', 'ok']
+    assert not framer.buffer and framer.oversize_head is None
+
+
+def test_oversize_line_in_one_chunk_is_skipped():
+    framer = LineFramer(max_line_length=5, oversize_policy='skip')
+    assert framer.feed(b'a\n0123456789\nb\n') == ['a', 'b']
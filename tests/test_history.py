@@ -0,0 +1,67 @@
+import asyncio
+import os
+
+from core.chat_reader import save_messages
+from core.history import LEGACY_HISTORY_FILE_NAME, HistoryLog, HistoryPager, list_segments
+from core.message import ChatMessage
+
+
+def test_last_batch_is_synced_by_time_in_quiet_chat(tmp_path):
+    async def check():
+        queue = asyncio.Queue()
+        async with HistoryLog(str(tmp_path), write_latency=0, fsync_interval=0.1) as history_log:
+            saving = asyncio.ensure_future(save_messages(history_log, queue))
+            await asyncio.sleep(0.2)
+            queue.put_nowait(ChatMessage.from_line('a: 1', 1.0))
+            await asyncio.sleep(0.01)
+            # first write after quiet time is synced at once, the next one waits for interval
+            queue.put_nowait(ChatMessage.from_line('a: 2', 1.0))
+            await asyncio.sleep(0.01)
+            assert history_log.unsynced_bytes
+            await asyncio.sleep(0.2)
+            assert not history_log.unsynced_bytes
+            saving.cancel()
+
+    asyncio.run(check())
+
+
+def write_lines(history_log_path, lines, **history_settings):
+    async def write():
+        async with HistoryLog(history_log_path, **history_settings) as history_log:
+            for line in lines:
+                # one message per batch, so segments rotate between messages
+                await history_log.write([ChatMessage.from_line(line, 1.0)])
+        return history_log.sequence_number
+
+    return asyncio.run(write())
+
+
+def read_lines(pager_call):
+    return [(message.sequence_number, message.to_line()) for message in asyncio.run(pager_call)]
+
+
+def test_rotated_compressed_segments_are_read_across(tmp_path):
+    history_log_path = str(tmp_path)
+    lines = [f'u: message {number}' for number in range(30)]
+    assert write_lines(history_log_path, lines, segment_size=100, compression='gzip') == 30
+    assert len(list_segments(history_log_path)) > 3
+    assert any(file_name.endswith('.gz') for file_name in os.listdir(history_log_path))
+
+    pager = HistoryPager(history_log_path)
+    assert read_lines(pager.read_tail(5)) == list(enumerate(lines))[-5:]
+    assert read_lines(pager.read_range(3, 20)) == list(enumerate(lines))[3:23]
+    assert read_lines(pager.read_range(28, 10)) == list(enumerate(lines))[28:]
+
+
+def test_numbering_goes_on_after_reopen(tmp_path):
+    history_log_path = str(tmp_path)
+    write_lines(history_log_path, ['u: 1', 'u: 2'], segment_size=10, compression='gzip')
+    assert write_lines(history_log_path, ['u: 3'], segment_size=10, compression='gzip') == 3
+    assert read_lines(HistoryPager(history_log_path).read_tail(10)) == [(0, 'u: 1'), (1, 'u: 2'), (2, 'u: 3')]
+
+
+def test_legacy_history_is_migrated(tmp_path):
+    with open(tmp_path / LEGACY_HISTORY_FILE_NAME, 'w') as legacy_file:
+        legacy_file.write('a: old\nb: older\n')
+    assert write_lines(str(tmp_path), ['c: new']) == 3
+    assert read_lines(HistoryPager(str(tmp_path)).read_tail(10)) == [(0, 'a: old'), (1, 'b: older'), (2, 'c: new')]
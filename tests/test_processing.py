@@ -0,0 +1,71 @@
+import asyncio
+import os
+
+from core.message import ChatMessage
+from core.processing import MessageProcessor, apply_display_rules, apply_rules, load_rules
+
+
+def drop_bots(message):
+    return None if message.author == 'bot' else message
+
+
+def fail_on_odd(message):
+    message.body = 'changed'
+    if message.author == 'odd':
+        raise ValueError('odd message')
+    return message
+
+
+def kill_worker(message):
+    os._exit(1)
+
+
+def test_history_keeps_original_text_and_window_gets_marks():
+    rules, display_rules = load_rules('links,highlight,mask', 'vasya', 'damn')
+    message = ChatMessage.from_line('u: vasya damn http://x.ru', 1.0)
+    [(stored_message, shown_message)], _ = apply_rules(rules, display_rules, [message])
+    assert stored_message.body == 'vasya damn http://x.ru' and not stored_message.spans
+    assert shown_message.body == 'vasya **** http://x.ru'
+    assert sorted(shown_message.spans) == [(0, 5, 'message_highlight'), (11, 22, 'message_link')]
+
+
+def test_mask_history_is_explicit():
+    rules, display_rules = load_rules('mask', mask_words_config='damn', mask_history=True)
+    [(stored_message, shown_message)], _ = apply_rules(rules, display_rules, [ChatMessage.from_line('u: damn')])
+    assert stored_message.body == shown_message.body == '****'
+
+
+def test_own_rule_drops_messages_in_order():
+    rules, display_rules = load_rules(f'{__name__}:drop_bots')
+    messages = [ChatMessage.from_line(line) for line in ('a: 1', 'bot: 2', 'b: 3')]
+    processed_messages, _ = apply_rules(rules, display_rules, messages)
+    assert [stored.to_line() for stored, _ in processed_messages] == ['a: 1', 'b: 3']
+
+
+def test_display_rules_mark_messages_read_from_history():
+    _, display_rules = load_rules('links')
+    [message] = apply_display_rules(display_rules, [ChatMessage.from_record('1.000\tu\tsee http://x.ru', 7)])
+    assert message.sequence_number == 7 and message.spans == ((4, 15, 'message_link'),)
+
+
+def test_failed_rule_keeps_message_unchanged():
+    rules, display_rules = load_rules(f'{__name__}:fail_on_odd,links')
+    messages = [ChatMessage.from_line(line) for line in ('a: 1', 'odd: http://x.ru', 'b: 3')]
+    processed_messages, errors = apply_rules(rules, display_rules, messages)
+    assert [stored.to_line() for stored, _ in processed_messages] == ['a: changed', 'odd: http://x.ru', 'b: changed']
+    assert processed_messages[1][1].spans == ((0, 11, 'message_link'),)
+    assert len(errors) == 1
+
+
+def test_broken_process_pool_is_started_again():
+    rules, display_rules = load_rules(f'{__name__}:kill_worker')
+    messages = [ChatMessage.from_line('a: 1')]
+
+    async def process():
+        with MessageProcessor(rules, display_rules, pool='process', workers=1) as processor:
+            broken_executor = processor.executor
+            processed_messages = await processor.process(messages)
+            assert processor.executor is not broken_executor
+        return processed_messages
+
+    assert [(stored.to_line(), shown.to_line()) for stored, shown in asyncio.run(process())] == [('a: 1', 'a: 1')]
@@ -0,0 +1,44 @@
+from core.chat_reader import ReplayFilter
+from core.message import ChatMessage
+
+
+def feed_lines(replay_filter, lines):
+    return [
+        released.to_line()
+        for line in lines
+        for released in replay_filter.feed(ChatMessage.from_line(line))
+    ]
+
+
+def test_replay_of_window_tail_is_dropped():
+    replay_filter = ReplayFilter(['a: hi', 'b: +', 'c: ok', 'd: yo'])
+    replay_filter.resume()
+    assert feed_lines(replay_filter, ['c: ok', 'd: yo', 'e: new']) == ['e: new']
+
+
+def test_repeats_after_replay_are_kept():
+    replay_filter = ReplayFilter(['a: hi', 'b: +', 'c: ok', 'd: yo'])
+    replay_filter.resume()
+    assert feed_lines(replay_filter, ['c: ok', 'd: yo', 'b: +', 'e: new']) == ['b: +', 'e: new']
+
+
+def test_lines_not_matching_window_tail_are_let_through():
+    replay_filter = ReplayFilter(['a: hi', 'b: +', 'c: ok', 'd: yo'])
+    replay_filter.resume()
+    assert feed_lines(replay_filter, ['b: +', 'c: ok', 'e: new']) == ['b: +', 'c: ok', 'e: new']
+
+
+def test_window_keeps_only_last_lines():
+    replay_filter = ReplayFilter(['a: 1', 'a: 2', 'a: 3'], window=2)
+    replay_filter.resume()
+    assert feed_lines(replay_filter, ['a: 1', 'a: 2', 'a: 3']) == ['a: 1', 'a: 2', 'a: 3']
+    replay_filter.resume()
+    assert feed_lines(replay_filter, ['a: 2', 'a: 3', 'a: 4']) == ['a: 4']
+
+
+def test_held_lines_are_released_when_burst_stops():
+    replay_filter = ReplayFilter(['a: +', 'b: ok', 'c: yo'])
+    replay_filter.resume()
+    assert feed_lines(replay_filter, ['a: +']) == []
+    assert [message.to_line() for message in replay_filter.release_held()] == ['a: +']
+    assert feed_lines(replay_filter, ['b: ok']) == ['b: ok']
@@ -0,0 +1,44 @@
+import asyncio
+
+from core.spool import OutboundSpool
+
+
+async def send_batch(spool, max_batch=10):
+    entries = await spool.get_batch(max_batch)
+    spool.mark_sent(entries)
+    return [text for _, text, _ in entries]
+
+
+def test_not_confirmed_entries_are_loaded_again_in_order(tmp_path):
+    spool_path = str(tmp_path / 'outbound.spool')
+
+    async def send_and_stop():
+        async with OutboundSpool(spool_path) as spool:
+            spool.nickname = 'neo'
+            for text in ('one', 'two', 'three'):
+                spool.put_nowait(text)
+            await spool._save()
+            assert await send_batch(spool) == ['one', 'two', 'three']
+            spool.confirm_echo('neo: two')
+            await spool._save()
+
+    async def reload():
+        async with OutboundSpool(spool_path) as spool:
+            return await send_batch(spool)
+
+    asyncio.run(send_and_stop())
+    assert asyncio.run(reload()) == ['one', 'three']
+
+
+def test_requeued_entries_go_before_new_ones():
+    async def check():
+        spool = OutboundSpool()
+        spool.put_nowait('one')
+        await spool._save()
+        await send_batch(spool)
+        spool.put_nowait('two')
+        await spool._save()
+        spool.requeue_in_flight()
+        return await send_batch(spool)
+
+    assert asyncio.run(check()) == ['one', 'two']